@@ -0,0 +1,119 @@
+# coding: utf-8
+"""Release-time static asset pipeline.
+
+Static files are fingerprinted (`app.css` also gets a copy named
+`app.<hash>.css`, listed in `manifest.json`) so they can be served with
+far-future expiry, and text assets are precompressed once per release for
+nginx `gzip_static` (and `brotli_static` if the brotli package is installed
+locally). The resulting directory can also be pushed with
+`fabix.aws.s3.sync_dir_up`.
+"""
+import gzip
+import json
+import os
+import re
+import shutil
+from multiprocessing import Pool, cpu_count
+
+import fabric.api as fab
+
+from fabix import cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+COMPRESS_MIN_SIZE = 256
+TEXT_EXTENSIONS = ('.css', '.js', '.json', '.map', '.svg', '.html', '.htm', '.xml', '.txt',
+                   '.ico', '.ttf', '.otf', '.eot')
+
+_COMPRESSED_EXTENSIONS = ('.gz', '.br')
+_FINGERPRINT_RE = re.compile(r'\.[0-9a-f]{%d}$' % HASH_LENGTH)
+
+
+def build(static_dir, fingerprint=True, compress=True, use_brotli=False, workers=None):
+    """Fingerprint and precompress the files under `static_dir` in place.
+
+    Compression runs in `workers` processes, one per local core by default.
+    Returns the manifest mapping each original path to its fingerprinted
+    path."""
+    if use_brotli and brotli is None:
+        fab.abort("Brotli compression needs the brotli package")
+
+    paths = []
+    for root, dirs, files in os.walk(static_dir):
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), static_dir)
+            if path != MANIFEST and not path.endswith(_COMPRESSED_EXTENSIONS):
+                paths.append(path)
+
+    manifest = {}
+    if fingerprint:
+        for path in sorted(paths):
+            base, ext = os.path.splitext(path)
+            if _FINGERPRINT_RE.search(base):
+                continue
+            hashed = '{0}.{1}{2}'.format(base, cache.file_digest(os.path.join(static_dir, path), 'md5')[:HASH_LENGTH], ext)
+            shutil.copy2(os.path.join(static_dir, path), os.path.join(static_dir, hashed))
+            manifest[path] = hashed
+        with open(os.path.join(static_dir, MANIFEST), 'w') as fd:
+            json.dump(manifest, fd, indent=2, sort_keys=True)
+
+    if compress:
+        targets = [os.path.join(static_dir, path) for path in paths + list(manifest.values()) + [MANIFEST]
+                   if path.lower().endswith(TEXT_EXTENSIONS)]
+        pool = Pool(int(workers or cpu_count()))
+        try:
+            saved = sum(pool.map(_compress, [(path, use_brotli) for path in targets], chunksize=16))
+        finally:
+            pool.close()
+            pool.join()
+        fab.puts("Precompressed {0} static files, saving {1} bytes per full download".format(len(targets), saved))
+
+    return manifest
+
+
+def _compress(args):
+    """Write `path`.gz (and `path`.br) if smaller than `path`, return bytes saved."""
+    path, use_brotli = args
+    size = os.path.getsize(path)
+    if size < COMPRESS_MIN_SIZE:
+        return 0
+
+    with open(path, 'rb') as fd:
+        content = fd.read()
+
+    # mtime=0 keeps the output identical across builds of the same content
+    with open(path + '.gz', 'wb') as out:
+        with gzip.GzipFile('', 'wb', 9, out, mtime=0) as gz:
+            gz.write(content)
+    saved = _keep_if_smaller(path + '.gz', size)
+    if use_brotli:
+        with open(path + '.br', 'wb') as out:
+            out.write(brotli.compress(content, quality=11))
+        saved = max(saved, _keep_if_smaller(path + '.br', size))
+
+    # nginx sends the mtime of the precompressed file as Last-Modified
+    stat = os.stat(path)
+    for compressed in (path + '.gz', path + '.br'):
+        if os.path.exists(compressed):
+            os.utime(compressed, (stat.st_atime, stat.st_mtime))
+    return saved
+
+
+def _keep_if_smaller(path, original_size):
+    saved = original_size - os.path.getsize(path)
+    if saved <= 0:
+        os.remove(path)
+        return 0
+    return saved
+
+
+@fab.task
+def build_static(static_dir, fingerprint=True, compress=True, use_brotli=False, workers=None):
+    """Fingerprint and precompress local static files under `static_dir`."""
+    fab.puts("Building static assets in {0}".format(static_dir))
+    build(static_dir, fingerprint, compress, use_brotli, workers)
@@ -96,8 +96,9 @@ def setup_autoscale(name, ami_id, key_name, security_groups, load_balancers,
     create_scaling_policy(conn_as, sp_down_name, group_name, sp_down_adjustment, sp_down_cooldown)
 
 
-def get_autoscaling_instances(elb_name):
-    """Get public DNS from autoscaling instances registered with ELB `elb_name`."""
+def get_autoscaling_instances(elb_name, attribute='public_dns_name'):
+    """Get `attribute` (public DNS by default) of running autoscaling
+    instances registered with ELB `elb_name`."""
     elb_conn = boto.connect_elb()
     loadbalancers = elb_conn.get_all_load_balancers([elb_name])
 
@@ -105,12 +106,17 @@ def get_autoscaling_instances(elb_name):
     for instance in loadbalancers[0].instances:
         instances_ids.append(instance.id)
 
+    if not instances_ids:
+        return []
+
     ec2_conn = boto.connect_ec2()
     reservations = ec2_conn.get_all_instances(instances_ids)
 
     ec2_instances = []
     for reservation in reservations:
-        ec2_instances.append(reservation.instances[0].public_dns_name)
+        for instance in reservation.instances:
+            if instance.state == 'running':
+                ec2_instances.append(getattr(instance, attribute))
     return ec2_instances
 
 
@@ -1,41 +1,274 @@
+import base64
+import binascii
+import hashlib
+import json
+import mimetypes
 import os
+import threading
+import time
 
 import boto
-from boto.utils import compute_md5
-from fabric.api import puts, task
+from boto.exception import BotoClientError, BotoServerError
+from boto.s3.multipart import MultiPartUpload
+from fabric.api import abort, puts, task
+
+from fabix import cache, trace
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+# Keyword arguments for boto.connect_s3, e.g. host, port, is_secure and
+# calling_format (boto.s3.connection.OrdinaryCallingFormat()) to use a
+# local S3-compatible service.
+S3_CONNECTION = {}
+
+SYNC_WORKERS = 8
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+HASH_BUFFER_SIZE = 1024 ** 2
+
+# Files above MULTIPART_THRESHOLD are uploaded in parts of
+# MULTIPART_CHUNK_SIZE (more for files over 10000 parts), sent by
+# MULTIPART_WORKERS threads.
+MULTIPART_THRESHOLD = 64 * 1024 ** 2
+MULTIPART_CHUNK_SIZE = 8 * 1024 ** 2
+MULTIPART_WORKERS = 4
+MULTIPART_MAX_PARTS = 10000
+
+# Part sizes tried to match multipart ETags, besides the one inferred from
+# the part count: defaults of the AWS CLI and SDKs and boto's minimum.
+MULTIPART_PART_SIZES = [MULTIPART_CHUNK_SIZE, 5 * 1024 ** 2, 16 * 1024 ** 2, 15 * 1024 ** 2, 64 * 1024 ** 2]
+
+_RETRYABLE_ERRORS = (EnvironmentError, BotoClientError, BotoServerError)
+
+
+def connect():
+    """Return a new S3 connection configured by `S3_CONNECTION`."""
+    return boto.connect_s3(**S3_CONNECTION)
 
 
 def upload_file(bucket, key_name, file_path, remote_prefix=None, policy='public-read', metadata=None):
+    return _upload_file(bucket, key_name, file_path, remote_prefix, policy, metadata)[1]
+
+
+def _upload_file(bucket, key_name, file_path, remote_prefix=None, policy='public-read', metadata=None,
+                 md5=None, lookup=True):
+    """Upload `file_path` unless unchanged, return ('uploaded' or 'skipped', key).
+
+    Without `lookup` the key is uploaded without checking it first."""
     if not metadata:
         metadata = {}
 
-    if remote_prefix:
-        key_name = '{0}/{1}'.format(remote_prefix, key_name)
+    key_name = _full_key_name(key_name, remote_prefix)
 
-    fd = open(file_path)
-    md5 = compute_md5(fd)
-    fd.close()
+    if md5 is None:
+        md5 = _md5_tuple(file_digests(file_path)[0], os.path.getsize(file_path))
 
     current_md5 = None
-    current_key = bucket.lookup(key_name)
+    current_key = bucket.lookup(key_name) if lookup else None
     if current_key:
         current_md5 = current_key.get_metadata('fabix-md5')
         if current_md5 == md5[0]:
-            for k, v in metadata.iteritems():
+            for k, v in metadata.items():
                 current_key.set_metadata(k, v)
             puts("Skip file {0}".format(file_path))
-            return current_key
+            return 'skipped', current_key
 
     key = bucket.new_key(key_name)
 
-    for k, v in metadata.iteritems():
+    for k, v in metadata.items():
         key.set_metadata(k, v)
 
     key.set_metadata('fabix-md5', md5[0])
 
     puts("Upload file {0}".format(file_path))
-    key.set_contents_from_filename(file_path, md5=md5, policy=policy)
-    return key
+    if md5[2] > MULTIPART_THRESHOLD:
+        _multipart_upload(bucket, key, file_path, md5[2], policy)
+    else:
+        key.set_contents_from_filename(file_path, md5=md5, policy=policy)
+    return 'uploaded', key
+
+
+def _multipart_upload(bucket, key, file_path, size, policy):
+    """Upload `file_path` to `key` in parts sent by parallel threads.
+
+    A failing part is retried on its own, and the upload is cancelled if it
+    still fails, so no incomplete parts are left billed in the bucket."""
+    mb = 1024 ** 2
+    part_size = max(MULTIPART_CHUNK_SIZE, -(-size // MULTIPART_MAX_PARTS // mb) * mb)
+    parts = list(range(1, -(-size // part_size) + 1))
+    # set_contents_from_filename guesses the type from the name, do the same
+    headers = {'Content-Type': mimetypes.guess_type(file_path)[0] or key.DefaultContentType}
+    upload = bucket.initiate_multipart_upload(key.name, headers=headers, metadata=key.metadata, policy=policy)
+    puts("Uploading {0} in {1} parts of {2} bytes".format(file_path, len(parts), part_size))
+
+    errors = []
+    lock = threading.Lock()
+
+    def worker(part_upload):
+        while True:
+            with lock:
+                if not parts or errors:
+                    return
+                part_num = parts.pop(0)
+            try:
+                _upload_part(part_upload, file_path, part_num, part_size, size)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    threads = []
+    for i in range(min(MULTIPART_WORKERS, len(parts))):
+        # boto connections aren't thread safe, every thread gets its own
+        part_upload = MultiPartUpload(connect().get_bucket(bucket.name, validate=False))
+        part_upload.key_name, part_upload.id = upload.key_name, upload.id
+        threads.append(threading.Thread(target=worker, args=(part_upload,)))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        upload.cancel_upload()
+        raise errors[0]
+    upload.complete_upload()
+
+
+def _upload_part(part_upload, file_path, part_num, part_size, size):
+    offset = (part_num - 1) * part_size
+    length = min(part_size, size - offset)
+    with open(file_path, 'rb') as fd:
+        fd.seek(offset)
+        md5 = hashlib.md5(fd.read(length)).hexdigest()
+
+        for attempt in range(MAX_RETRIES + 1):
+            fd.seek(offset)
+            try:
+                with trace.span('upload part {0} of {1}'.format(part_num, file_path), bytes_sent=length):
+                    part_upload.upload_part_from_file(fd, part_num, md5=_md5_tuple(md5, length), size=length)
+                return
+            except _RETRYABLE_ERRORS:
+                if attempt == MAX_RETRIES:
+                    raise
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+
+def _full_key_name(key_name, remote_prefix=None):
+    if remote_prefix:
+        return '{0}/{1}'.format(remote_prefix, key_name)
+    return key_name
+
+
+def file_digests(file_path, part_size=MULTIPART_CHUNK_SIZE):
+    """Return the MD5 hex digest of `file_path` and its multipart ETag for
+    parts of `part_size`, reading the file once in fixed size chunks."""
+    md5, part_md5 = hashlib.md5(), hashlib.md5()
+    part_length, digests = 0, []
+    with trace.span('compute_md5 {0}'.format(file_path), bytes_read=os.path.getsize(file_path)):
+        with open(file_path, 'rb') as fd:
+            while True:
+                chunk = fd.read(min(HASH_BUFFER_SIZE, part_size - part_length))
+                if not chunk:
+                    break
+                md5.update(chunk)
+                part_md5.update(chunk)
+                part_length += len(chunk)
+                if part_length == part_size:
+                    digests.append(part_md5.digest())
+                    part_md5, part_length = hashlib.md5(), 0
+    if part_length or not digests:
+        digests.append(part_md5.digest())
+    return md5.hexdigest(), '{0}-{1}'.format(hashlib.md5(b''.join(digests)).hexdigest(), len(digests))
+
+
+def _md5_tuple(md5, size):
+    """Return hex digest `md5` in the (hex, base64, size) form boto takes."""
+    return md5, base64.b64encode(binascii.unhexlify(md5)).decode('ascii'), size
+
+
+class HashManifest(object):
+    """Digests of the files under `local_path` computed by earlier syncs.
+
+    Entries are kept in the local fabix cache and reused while the file's
+    size, mtime and inode are unchanged, so only new or modified files are
+    read again."""
+
+    def __init__(self, local_path):
+        self.path = cache.entry_path('hashes', cache.cache_key(os.path.abspath(local_path)), '.json')
+        self.hashed = 0
+        self._entries = {}
+        self._seen = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as fd:
+                self._entries = json.load(fd)
+
+    def digests(self, file_path):
+        """Return the MD5 hex digest and multipart ETag of `file_path`."""
+        stat = os.stat(file_path)
+        signature = [stat.st_size, stat.st_mtime, stat.st_ino]
+        with self._lock:
+            entry = self._entries.get(file_path)
+        if entry and entry[:3] == signature:
+            digests = entry[3:]
+        else:
+            digests = list(file_digests(file_path))
+            with self._lock:
+                self.hashed += 1
+        with self._lock:
+            self._seen[file_path] = signature + digests
+        return digests[0], digests[1]
+
+    def save(self):
+        """Write entries of the files seen in this run, dropping the others."""
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as fd:
+            json.dump(self._seen, fd)
+        os.rename(tmp_path, self.path)
+
+
+def multipart_etag(file_path, part_size):
+    """Return the ETag S3 gives `file_path` uploaded in parts of `part_size`."""
+    return file_digests(file_path, part_size)[1]
+
+
+def _matches_etag(file_path, md5, multipart, etag, size):
+    """Tell whether local `file_path`, with hex digest `md5` and default
+    multipart ETag `multipart`, is the remote key with `etag` and `size`."""
+    if size != os.path.getsize(file_path):
+        return False
+    if etag in (md5, multipart):
+        return True
+    if '-' not in etag:
+        return False
+
+    parts = int(etag.rsplit('-', 1)[1])
+    # the part size is at least size/parts and, for the last part to be
+    # non-empty, below size/(parts - 1); uploaders round it to whole MBs
+    mb = 1024 ** 2
+    inferred = -(-size // parts)
+    candidates = MULTIPART_PART_SIZES + [inferred, -(-inferred // mb) * mb]
+    for part_size in sorted(set(candidates)):
+        if -(-size // part_size) == parts and multipart_etag(file_path, part_size) == etag:
+            return True
+    return False
+
+
+def remote_index(bucket, remote_prefix=None):
+    """Return a dict mapping each key under `remote_prefix` to its (ETag, size).
+
+    The bucket listing is paginated, 1000 keys per request."""
+    prefix = remote_prefix + '/' if remote_prefix else ''
+    index = {}
+    for key in bucket.list(prefix=prefix):
+        index[key.name] = (key.etag.strip('"'), int(key.size))
+    return index
 
 
 def get_key_name(local_path, fullpath):
@@ -46,14 +279,96 @@ def get_key_name(local_path, fullpath):
 
 
 @task
-def sync_dir_up(bucket_name, local_path, remote_prefix=None, metadata=None):
-    puts("Sync directory {0} with bucket {1}".format(bucket_name, local_path))
-    conn = boto.connect_s3()
-    bucket = conn.get_bucket(bucket_name)
+def sync_dir_up(bucket_name, local_path, remote_prefix=None, metadata=None, workers=SYNC_WORKERS):
+    """Sync directory `local_path` up to bucket `bucket_name`.
+
+    The prefix is listed once and files whose ETag and size match the
+    listing are skipped without further requests. The others are uploaded
+    by `workers` threads, each with its own S3 connection, fed through a
+    bounded queue. A failing file is retried with
+    exponential backoff. Aborts after the report if any file failed.
+
+    Local digests are kept between runs (see `HashManifest`), so
+    unchanged files are not read again."""
+    puts("Sync directory {0} with bucket {1}".format(local_path, bucket_name))
+    workers = int(workers)
+    report = {'uploaded': 0, 'skipped': 0, 'failed': [], 'bytes': 0}
+    lock = threading.Lock()
+    queue = Queue(maxsize=workers * 4)
+
+    def worker(bucket):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            key_name, file_path, remote = item
+            status = _sync_file(bucket, key_name, file_path, remote_prefix, metadata, remote, hashes)
+            with lock:
+                if status == 'failed':
+                    report['failed'].append(file_path)
+                else:
+                    report[status] += 1
+                    if status == 'uploaded':
+                        report['bytes'] += os.path.getsize(file_path)
+
+    start = time.time()
+    hashes = HashManifest(local_path)
+    index = remote_index(connect().get_bucket(bucket_name, validate=False), remote_prefix)
+    puts("Found {0} keys in bucket {1}".format(len(index), bucket_name))
+
+    buckets = [connect().get_bucket(bucket_name, validate=False) for i in range(workers)]
+    threads = [threading.Thread(target=worker, args=(bucket,)) for bucket in buckets]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
 
     for root, dirs, files in os.walk(local_path):
         for fname in files:
             file_path = os.path.join(root, fname)
             key_name = get_key_name(local_path, file_path)
+            queue.put((key_name, file_path, index.get(_full_key_name(key_name, remote_prefix))))
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    hashes.save()
+
+    elapsed = time.time() - start
+    total = report['uploaded'] + report['skipped'] + len(report['failed'])
+    puts("Synced {0} files in {1:.1f}s ({2:.1f} files/s): {3} uploaded, {4} skipped, {5} failed, "
+         "{6} hashed, {7:.2f} MB/s".format(total, elapsed, total / max(elapsed, 0.001), report['uploaded'],
+                                           report['skipped'], len(report['failed']), hashes.hashed,
+                                           report['bytes'] / 1024.0 / 1024.0 / max(elapsed, 0.001)))
+    if report['failed']:
+        abort("Failed to upload {0}".format(', '.join(sorted(report['failed']))))
+    return report
+
+
+def _sync_file(bucket, key_name, file_path, remote_prefix, metadata, remote, hashes):
+    """Upload `file_path` unless it matches `remote`, its listed (ETag, size)."""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            md5, multipart = hashes.digests(file_path)
+            if remote is not None and _unchanged(bucket, _full_key_name(key_name, remote_prefix),
+                                                 file_path, md5, multipart, remote):
+                puts("Skip file {0}".format(file_path))
+                return 'skipped'
+            return _upload_file(bucket, key_name, file_path, remote_prefix=remote_prefix, metadata=metadata,
+                                md5=_md5_tuple(md5, os.path.getsize(file_path)), lookup=False)[0]
+        except Exception as e:
+            if attempt == MAX_RETRIES or not isinstance(e, _RETRYABLE_ERRORS):
+                puts("Failed to upload {0}: {1}".format(file_path, e))
+                return 'failed'
+            time.sleep(RETRY_BACKOFF * 2 ** attempt)
+
 
-            upload_file(bucket, key_name, file_path, remote_prefix=remote_prefix, metadata=metadata)
+def _unchanged(bucket, key_name, file_path, md5, multipart, remote):
+    etag, size = remote
+    if size != os.path.getsize(file_path):
+        return False
+    if _matches_etag(file_path, md5, multipart, etag, size):
+        return True
+    # the ETag isn't an MD5 of the content (e.g. SSE-KMS or unknown part
+    # size), fall back to the digest recorded at upload
+    key = bucket.get_key(key_name)
+    return key is not None and key.get_metadata('fabix-md5') == md5
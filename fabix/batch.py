@@ -0,0 +1,93 @@
+# coding: utf-8
+import fabric.api as fab
+
+_MARKER = '__fabix_batch__'
+
+
+class BatchResult(str):
+    """Output of one batched command.
+
+    Mirrors the attributes of fabric's run/sudo results: `command`,
+    `return_code`, `failed` and `succeeded`."""
+    def __new__(cls, output, command, return_code):
+        result = str.__new__(cls, output)
+        result.command = command
+        result.return_code = return_code
+        result.failed = return_code != 0
+        result.succeeded = not result.failed
+        return result
+
+
+class batch(object):
+    """Collect remote commands and run them as one script over a single exec.
+
+    Usage::
+
+        with batch(use_sudo=True) as cmds:
+            cmds.run('src_dir=$(mktemp -d)')
+            cmds.run('tar xzf /tmp/foo.tar.gz -C "$src_dir"')
+
+    Commands run in order in the same shell, so variables and `cd` carry
+    over from one command to the next. The script stops at the first failing
+    command, which aborts the task unless `warn_only` is set. After the block
+    `cmds.results` holds one `BatchResult` per command that ran."""
+
+    def __init__(self, use_sudo=False):
+        self.use_sudo = use_sudo
+        self.commands = []
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None and self.commands:
+            self.execute()
+
+    def run(self, command):
+        self.commands.append(command)
+
+    def execute(self):
+        """Run the collected commands and return their results."""
+        lines = []
+        for index, command in enumerate(self.commands):
+            fab.puts("[batch] {0}".format(command))
+            lines.append(
+                "echo {marker}:{index}:start\n"
+                "{{ {command}\n}} 2>&1\n"
+                "__fabix_rc=$?; echo; echo {marker}:{index}:$__fabix_rc\n"
+                "[ $__fabix_rc -eq 0 ] || exit $__fabix_rc".format(marker=_MARKER, index=index, command=command))
+
+        runner = fab.sudo if self.use_sudo else fab.run
+        with fab.settings(fab.hide('running'), warn_only=True):
+            output = runner('\n'.join(lines))
+
+        self.results = self._parse(output)
+        self.commands = []
+
+        failed = [result for result in self.results if result.failed]
+        if (failed or output.failed) and not fab.env.warn_only:
+            if failed:
+                fab.abort("Batched command failed with exit code {0}: {1}\n{2}".format(
+                    failed[0].return_code, failed[0].command, failed[0]))
+            fab.abort("Batched commands failed with exit code {0}".format(output.return_code))
+        return self.results
+
+    def _parse(self, output):
+        results = []
+        current, buf = None, []
+        for line in str(output).replace('\r\n', '\n').split('\n'):
+            if not line.startswith(_MARKER + ':'):
+                buf.append(line)
+                continue
+
+            index, status = line[len(_MARKER) + 1:].split(':', 1)
+            if status == 'start':
+                current, buf = int(index), []
+            elif current is not None:
+                # drop the line break echoed before the end marker
+                if buf and not buf[-1]:
+                    buf.pop()
+                results.append(BatchResult('\n'.join(buf), self.commands[current], int(status)))
+                current = None
+        return results
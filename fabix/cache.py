@@ -0,0 +1,131 @@
+# coding: utf-8
+import hashlib
+import os
+import shutil
+import time
+
+import fabric.api as fab
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.fabix', 'cache')
+DEFAULT_MAX_SIZE = 1024 ** 3
+MAX_SIZES = {
+    'archives': 2 * 1024 ** 3,
+}
+
+
+def cache_key(*parts):
+    """Return a stable key for the tuple `parts`."""
+    return hashlib.sha1('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def file_digest(path, algorithm='sha256'):
+    """Return the hex digest of the contents of `path`, read in chunks."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1024 ** 2), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def entry_path(bucket, key, suffix=''):
+    return os.path.join(CACHE_DIR, bucket, key + suffix)
+
+
+def lookup(bucket, key, suffix=''):
+    """Return the cached path for `key` in `bucket` or None if not cached.
+
+    A hit refreshes the entry's mtime, which is what LRU eviction uses."""
+    path = entry_path(bucket, key, suffix)
+    if not os.path.exists(path):
+        return None
+    os.utime(path, None)
+    return path
+
+
+def store(bucket, key, src_path, suffix=''):
+    """Move `src_path` (a file or directory) into the cache and return its new path.
+
+    The entry appears atomically, so parallel tasks never see it half written.
+    The bucket is pruned to its size limit afterwards."""
+    path = entry_path(bucket, key, suffix)
+    bucket_dir = os.path.dirname(path)
+    if not os.path.isdir(bucket_dir):
+        os.makedirs(bucket_dir)
+
+    tmp_path = '{0}.tmp-{1}'.format(path, os.getpid())
+    shutil.move(src_path, tmp_path)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+    _evict(bucket, MAX_SIZES.get(bucket, DEFAULT_MAX_SIZE), keep=path)
+    return path
+
+
+def entries(bucket):
+    """Return (path, size, mtime) for each entry of `bucket`, most recent first."""
+    bucket_dir = os.path.join(CACHE_DIR, bucket)
+    if not os.path.isdir(bucket_dir):
+        return []
+
+    result = []
+    for name in os.listdir(bucket_dir):
+        if '.tmp-' in name:
+            continue
+        path = os.path.join(bucket_dir, name)
+        result.append((path, _size(path), os.path.getmtime(path)))
+    return sorted(result, key=lambda entry: entry[2], reverse=True)
+
+
+def _size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for fname in files:
+            total += os.path.getsize(os.path.join(root, fname))
+    return total
+
+
+def _evict(bucket, limit, keep=None):
+    total = 0
+    for path, size, mtime in entries(bucket):
+        total += size
+        if total <= limit or path == keep:
+            continue
+        fab.puts("Evicting {0} from {1} cache".format(os.path.basename(path), bucket))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def _buckets():
+    if not os.path.isdir(CACHE_DIR):
+        return []
+    return sorted(os.listdir(CACHE_DIR))
+
+
+@fab.task
+def show(bucket=None):
+    """Show local cache usage, per entry if `bucket` is given."""
+    for name in ([bucket] if bucket else _buckets()):
+        bucket_entries = entries(name)
+        total = sum(size for path, size, mtime in bucket_entries)
+        fab.puts("{0}: {1} entries, {2} of {3} bytes".format(
+            name, len(bucket_entries), total, MAX_SIZES.get(name, DEFAULT_MAX_SIZE)))
+        if bucket:
+            for path, size, mtime in bucket_entries:
+                fab.puts("  {0} {1} {2}".format(
+                    time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(mtime)), size, os.path.basename(path)))
+
+
+@fab.task
+def prune(bucket=None, max_size=None):
+    """Evict least recently used entries until `bucket` fits in `max_size` bytes.
+
+    Without `bucket` every bucket is pruned to its configured limit."""
+    for name in ([bucket] if bucket else _buckets()):
+        limit = int(max_size) if max_size is not None else MAX_SIZES.get(name, DEFAULT_MAX_SIZE)
+        _evict(name, limit)
@@ -0,0 +1,139 @@
+# coding: utf-8
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from tempfile import mkstemp
+
+import fabric.api as fab
+
+from fabix import cache
+
+try:
+    from urllib2 import urlopen
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from urllib.request import urlopen
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# How hosts get source tarballs: 'direct' downloads them on each host,
+# 'push' sends the locally cached copy over SSH and 'tunnel' serves it from
+# a local HTTP server through an SSH remote tunnel.
+MODE = 'direct'
+
+# sha256 pins per download URL. Sections can also pin their own sources
+# (e.g. `source_sha256` in the python and nginx config).
+CHECKSUMS = {}
+
+TUNNEL_PORT = 8765
+
+
+def fetch(url, sha256=None):
+    """Download `url` once into the local source cache and return its path.
+
+    The tarball is checked against `sha256` or its pin in `CHECKSUMS`. An
+    unpinned download is checked against the checksum recorded the first
+    time it was fetched."""
+    return _fetch(url, sha256)[0]
+
+
+def _fetch(url, sha256=None):
+    sha256 = sha256 or CHECKSUMS.get(url)
+    key = cache.cache_key(url)
+    path = cache.lookup('sources', key, _suffix(url))
+    if path is None:
+        fab.puts("Downloading {0}".format(url))
+        fd, tmp_path = mkstemp()
+        with os.fdopen(fd, 'wb') as out:
+            shutil.copyfileobj(urlopen(url), out, 64 * 1024)
+        path = cache.store('sources', key, tmp_path, _suffix(url))
+
+    digest = cache.file_digest(path)
+    recorded = cache.lookup('sources', key, '.sha256')
+    if sha256 is None and recorded is not None:
+        sha256 = open(recorded).read().strip()
+    if sha256 is not None and digest != sha256:
+        os.remove(path)
+        fab.abort("Checksum mismatch for {0}: expected {1}, got {2}".format(url, sha256, digest))
+    if sha256 is None:
+        fab.warn("No checksum pinned for {0}, recording {1}".format(url, digest))
+        with open(cache.entry_path('sources', key, '.sha256'), 'w') as fd:
+            fd.write(digest + '\n')
+    return path, digest
+
+
+def _suffix(url):
+    name = os.path.basename(url)
+    for suffix in ('.tar.gz', '.tar.bz2', '.tar.xz', '.tgz'):
+        if name.endswith(suffix):
+            return suffix
+    return os.path.splitext(name)[1]
+
+
+def _unpack_command(name, sha256):
+    verify = ''
+    if sha256:
+        verify = 'echo "{0}  {1}" | sha256sum -c --quiet - && '.format(sha256, name)
+    return '{verify}tar xf {name} && rm -f {name}'.format(verify=verify, name=name)
+
+
+@contextmanager
+def source(url, sha256=None):
+    """Yield a shell command unpacking tarball `url` in the remote current dir.
+
+    The command must run inside the block, since in tunnel mode the local
+    HTTP server only lives as long as the block."""
+    name = os.path.basename(url)
+    sha256 = sha256 or CHECKSUMS.get(url)
+
+    if MODE == 'direct':
+        if sha256 is None:
+            yield "wget -q '{0}' -O - | tar xz".format(url)
+        else:
+            yield "wget -q '{0}' -O {1} && {2}".format(url, name, _unpack_command(name, sha256))
+        return
+
+    path, sha256 = _fetch(url, sha256)
+
+    if MODE == 'push':
+        remote_path = '/tmp/fabix-src-{0}'.format(name)
+        fab.put(path, remote_path)
+        yield 'mv {0} {1} && {2}'.format(remote_path, name, _unpack_command(name, sha256))
+    elif MODE == 'tunnel':
+        server = _serve(path)
+        try:
+            with fab.remote_tunnel(TUNNEL_PORT, server.server_port, local_host='127.0.0.1'):
+                yield "wget -q 'http://127.0.0.1:{0}/{1}' -O {1} && {2}".format(
+                      TUNNEL_PORT, name, _unpack_command(name, sha256))
+        finally:
+            server.shutdown()
+            server.server_close()
+    else:
+        fab.abort("Unknown mirror mode {0}".format(MODE))
+
+
+def _serve(path):
+    """Serve file `path` over HTTP on an ephemeral local port, whatever the URL."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+            with open(path, 'rb') as fd:
+                shutil.copyfileobj(fd, self.wfile, 64 * 1024)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+@fab.task
+def prefetch(*urls):
+    """Download source tarballs `urls` into the local cache ahead of time."""
+    for url in urls:
+        fab.puts("{0} {1}".format(cache.file_digest(fetch(url)), url))
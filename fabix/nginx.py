@@ -1,15 +1,26 @@
 # coding: utf-8
+import hashlib
 import os
+import re
+import tarfile
+import time
+from contextlib import closing
 from functools import partial
+from io import BytesIO
+from tempfile import mkdtemp
 
 import cuisine
 import fabric.api as fab
 
-from fabix import get_config
+from fabix import get_config, mirror
+from fabix.batch import batch
+from fabix.system import facts
 
 _INSTALL_DIR = '/opt'
 _DOWNLOAD_URL = 'http://nginx.org/download/nginx-{version}.tar.gz'
 NGINX_USER = 'nginx'
+_BUILD_MARKER = '.fabix-build'
+CACHE_DIR = '/var/cache/nginx'
 ETC_DIR = os.path.join(os.path.dirname(__file__), 'support_files', 'etc')
 
 
@@ -18,42 +29,80 @@ get_config = partial(get_config, 'nginx')
 
 @fab.task
 def install(force=False):
-    """Install nginx HTTP server."""
+    """Install nginx HTTP server.
+
+    The build is set by the nginx config section: `modules` lists the
+    `--with-*` modules (only http_stub_status_module by default), while
+    `configure_flags`, `cc_opt` and `ld_opt` add build flags. An installed
+    nginx built with a different configuration is rebuilt. One installed by
+    older fabix versions, which leave no build marker, is taken as built
+    with the default options."""
     version = get_config()['version']
 
-    cuisine.package_install(['build-essential', 'libpcre3-dev', 'zlib1g-dev'])
-
     install_dir = os.path.join(_INSTALL_DIR, 'nginx', version)
     nginx_bin = os.path.join(install_dir, 'sbin', 'nginx')
-    if cuisine.file_exists(nginx_bin):
-        if not force:
+    build_marker = os.path.join(install_dir, _BUILD_MARKER)
+    configure_flags = _configure_flags(install_dir)
+    build_id = hashlib.sha1(' '.join(configure_flags).encode('utf-8')).hexdigest()
+
+    if facts.file_exists(nginx_bin):
+        with fab.settings(fab.hide('everything'), warn_only=True):
+            built = fab.run('cat {0}'.format(build_marker))
+        if built.failed:
+            # installed before build markers, with the then fixed options
+            legacy_flags = ['--prefix={0}'.format(install_dir), '--with-http_stub_status_module']
+            built = hashlib.sha1(' '.join(legacy_flags).encode('utf-8')).hexdigest()
+            if built == build_id:
+                fab.sudo("echo {0} > '{1}'".format(build_id, build_marker))
+        if built.strip() != build_id:
+            fab.puts("Nginx {0} was built with other options, rebuilding".format(version))
+        elif not force:
             fab.puts("Nginx {0} found, skipping installation".format(version))
             return
         else:
             fab.puts("Reinstalling nginx {0} found".format(version))
 
-    with cuisine.mode_sudo():
-        cuisine.dir_ensure(install_dir, True)
+    packages = ['build-essential', 'libpcre3-dev', 'zlib1g-dev']
+    if any('ssl' in flag or 'v2' in flag for flag in configure_flags):
+        packages.append('libssl-dev')
+    cuisine.package_install(packages)
 
     home_dir = os.path.join(install_dir, 'html')
-    cuisine.user_ensure(NGINX_USER, None, home_dir, shell='/sbin/nologin')
-    fab.sudo('passwd -l nginx')
-
     download_url = _DOWNLOAD_URL.format(version=version)
 
-    src_dir = fab.run('mktemp -d')
-    with fab.cd(src_dir):
-        fab.puts("Downloading nginx {0}".format(version))
-        fab.run("wget -q '{0}' -O - | tar xz".format(download_url))
-        with fab.cd('nginx-{0}'.format(version)):
-            fab.puts("Compiling nginx {0}".format(version))
-            fab.run("./configure --prefix={0} --with-http_stub_status_module".format(install_dir))
-            fab.run("make")
-            fab.puts("Installing nginx {0}".format(version))
-            fab.sudo('make install')
-            with cuisine.mode_sudo():
-                cuisine.dir_ensure("{0}{1}".format(install_dir, '/conf/sites-enabled'))
-    fab.run("rm -rf '{0}'".format(src_dir))
+    fab.puts("Downloading, compiling and installing nginx {0}".format(version))
+    with mirror.source(download_url, get_config().get('source_sha256')) as unpack_cmd, \
+            batch(use_sudo=True) as cmds:
+        cmds.run("mkdir -p '{0}'".format(install_dir))
+        cmds.run("id -u {user} >/dev/null 2>&1 || useradd -d '{home}' -s /sbin/nologin {user}".format(
+                 user=NGINX_USER, home=home_dir))
+        cmds.run('passwd -l {0}'.format(NGINX_USER))
+        cmds.run('src_dir=$(mktemp -d) && cd "$src_dir"')
+        cmds.run(unpack_cmd)
+        cmds.run('cd nginx-{0}'.format(version))
+        cmds.run("./configure {0}".format(' '.join(configure_flags)))
+        cmds.run("make -j {0}".format(facts.get().get('cpu_count') or 1))
+        cmds.run('make install')
+        cmds.run("mkdir -p '{0}{1}'".format(install_dir, '/conf/sites-enabled'))
+        cmds.run("echo {0} > '{1}'".format(build_id, build_marker))
+        cmds.run('cd / && rm -rf "$src_dir"')
+    facts.invalidate()
+
+
+def _configure_flags(install_dir):
+    config = get_config()
+
+    flags = ['--prefix={0}'.format(install_dir)]
+    for module in config.get('modules', ['http_stub_status_module']):
+        if not module.startswith('--'):
+            module = '--with-{0}'.format(module)
+        flags.append(module)
+    flags.extend(config.get('configure_flags', []))
+    if config.get('cc_opt'):
+        flags.append("--with-cc-opt='{0}'".format(config['cc_opt']))
+    if config.get('ld_opt'):
+        flags.append("--with-ld-opt='{0}'".format(config['ld_opt']))
+    return flags
 
 
 @fab.task
@@ -68,6 +117,7 @@ def uninstall():
     fab.puts("Removing {0}".format(install_dir))
     if fab.confirm("Are you sure?", default=False):
         fab.sudo("rm -rf '{0}'".format(install_dir))
+        facts.invalidate()
         fab.puts("Nginx {0} uninstalled".format(version))
 
 
@@ -93,14 +143,51 @@ def install_upstart():
         cuisine.file_write('/etc/init/nginx.conf', content)
 
 
+def tuning_context():
+    """Return nginx sizing values computed from the current host's facts.
+
+    Workers follow the core count. Open files and connections follow the
+    kernel file limit and memory, and buffers and caches follow memory."""
+    host = facts.get()
+    workers = host.get('cpu_count') or 1
+    memory_mb = (host.get('memory_kb') or 1024 * 1024) // 1024
+    file_max = host.get('file_max') or 65536
+    large = memory_mb >= 2048
+
+    nofile = min(65536, max(1024, file_max // (2 * workers)))
+    # a proxied connection uses two descriptors and about 16k of buffers
+    connections = min(16384, nofile // 2, max(512, memory_mb * 1024 // 4 // 16 // workers))
+
+    modules = get_config().get('modules', [])
+    return {
+        'worker_processes': workers,
+        'worker_rlimit_nofile': nofile,
+        'worker_connections': connections,
+        'keepalive_timeout': '30s',
+        'keepalive_requests': 1000,
+        'client_body_buffer_size': '16k' if large else '8k',
+        'large_client_header_buffer_size': '8k',
+        'proxy_buffer_size': '16k' if large else '4k',
+        'proxy_buffers': '16 16k' if large else '8 8k',
+        'open_file_cache_max': min(200000, max(1000, memory_mb * 10)),
+        'sendfile_aio': 'aio threads;' if 'threads' in modules else '',
+        'gzip_static': 'gzip_static on;' if 'http_gzip_static_module' in modules else '',
+    }
+
+
 @fab.task
-def put_conf(nginx_file):
-    """Install global nginx config."""
+def put_conf(nginx_file=None):
+    """Install global nginx config.
+
+    `nginx_file` is a template that can use `nginx_user`, `nginx_pid` and
+    the sizing values of `tuning_context`. Without it a default config sized
+    for the host is installed."""
     version = get_config()['version']
 
     install_dir = os.path.join(_INSTALL_DIR, 'nginx', version)
     conf_file = os.path.join(install_dir, 'conf', 'nginx.conf')
 
+    nginx_file = nginx_file or os.path.join(ETC_DIR, 'nginx', 'nginx.conf')
     if not os.path.exists(nginx_file):
         fab.abort("Nginx conf {0} not found".format(nginx_file))
 
@@ -110,41 +197,221 @@ def put_conf(nginx_file):
         'nginx_user': NGINX_USER,
         'nginx_pid': nginx_pid,
     }
+    context.update(tuning_context())
 
     tpl_content = open(nginx_file, 'rb').read()
     content = cuisine.text_template(tpl_content, context)
 
-    with cuisine.mode_sudo():
-        cuisine.file_write(conf_file, content)
+    return push_confs([(os.path.basename(conf_file), content)])
 
 
 @fab.task
-def put_site_conf(nginx_file, context=None):
-    """Install nginx config per site."""
-    version = get_config()['version']
+def put_site_conf(nginx_file, context=None, cache=False):
+    """Install nginx config per site.
+
+    See `put_site_confs` for `cache`."""
+    return put_site_confs(nginx_file, context=context, cache=cache)
+
+
+@fab.task
+def put_site_confs(*nginx_files, **kwargs):
+    """Install nginx configs for several sites in one transfer and reload.
+
+    If `context` is given every file is rendered as a template with it.
+    With `cache` each site gets a proxy cache zone: templates put
+    `${proxy_cache_path}` at the top of the file and `${proxy_cache}` in
+    the server or location blocks to cache (both are empty without
+    `cache`)."""
+    context = kwargs.get('context')
+    cache = kwargs.get('cache')
+
+    confs = []
+    for nginx_file in nginx_files:
+        if not os.path.exists(nginx_file):
+            fab.abort("Nginx conf {0} not found".format(nginx_file))
+
+        site_context = dict(context or {})
+        if context or cache:
+            site_context.update(cache_context(_site_name(nginx_file), enabled=cache))
+
+        content = open(nginx_file, 'rb').read()
+        if site_context:
+            content = cuisine.text_template(content, site_context)
+        confs.append((os.path.join('sites-enabled', os.path.basename(nginx_file)), content))
+
+    if cache:
+        _create_cache_dirs([_site_name(nginx_file) for nginx_file in nginx_files])
+
+    return push_confs(confs)
+
+
+def _site_name(nginx_file):
+    name = os.path.splitext(os.path.basename(nginx_file))[0]
+    return re.sub(r'\W', '_', name)
+
+
+def cache_context(site, enabled=True):
+    """Return the proxy cache directives of `site`.
+
+    `keys_zone` (about 8000 keys per MB) follows host memory and `max_size`
+    the free disk of /var. Responses are cached for `cache_valid` of the
+    nginx config (1s by default, i.e. microcaching), stale entries are
+    served while one request refreshes them. Requests where any of the
+    `cache_bypass` variables is set (an Authorization header or a Django
+    `sessionid` cookie by default) neither use nor fill the cache, so
+    logged-in pages are never shared. With `cache_status_header` an
+    X-Cache-Status header is added; note that `add_header` in a block
+    drops every `add_header` inherited from the enclosing ones."""
+    if not enabled:
+        return {'proxy_cache_path': '', 'proxy_cache': ''}
+
+    host = facts.get()
+    memory_mb = (host.get('memory_kb') or 1024 * 1024) // 1024
+    disk_free_mb = (host.get('disk_free_kb') or 1024 * 1024) // 1024
+    keys_zone = min(256, max(8, memory_mb // 128))
+    max_size = min(10240, max(64, disk_free_mb // 20))
+    config = get_config()
+    valid = config.get('cache_valid', '1s')
+    bypass = ' '.join(config.get('cache_bypass', ['$http_authorization', '$cookie_sessionid']))
+
+    cache_path = ('proxy_cache_path {dir} levels=1:2 keys_zone={site}:{keys_zone}m '
+                  'max_size={max_size}m inactive=10m use_temp_path=off;')
+    cache = [
+        'proxy_cache {0};'.format(site),
+        'proxy_cache_key $scheme$host$request_uri;',
+        'proxy_cache_valid 200 301 302 {0};'.format(valid),
+        'proxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;',
+        'proxy_cache_lock on;',
+        'proxy_cache_lock_timeout 5s;',
+        'proxy_cache_bypass {0};'.format(bypass),
+        'proxy_no_cache {0};'.format(bypass),
+    ]
+    if config.get('cache_status_header'):
+        cache.append('add_header X-Cache-Status $upstream_cache_status;')
+    return {
+        'proxy_cache_path': cache_path.format(dir=os.path.join(CACHE_DIR, site), site=site,
+                                              keys_zone=keys_zone, max_size=max_size),
+        'proxy_cache': '\n        '.join(cache),
+    }
 
-    if not os.path.exists(nginx_file):
-        fab.abort("Nginx conf {0} not found".format(nginx_file))
 
-    site_name = os.path.basename(nginx_file)
+def _create_cache_dirs(sites):
+    dirs = ' '.join(os.path.join(CACHE_DIR, site) for site in sites)
+    fab.sudo('mkdir -p {dirs} && chown {user}: {dirs} && chmod 700 {dirs}'.format(dirs=dirs, user=NGINX_USER))
+
+
+@fab.task
+def purge_cache(site):
+    """Remove all cached responses of `site`."""
+    cache_dir = os.path.join(CACHE_DIR, _site_name(site))
+    fab.puts("Purging {0}".format(cache_dir))
+    fab.sudo("find '{0}' -type f -delete".format(cache_dir))
+
+
+def push_confs(confs):
+    """Install `confs`, a list of (path relative to conf dir, content) pairs.
+
+    Files whose content is already on the host are skipped. The rest are
+    sent in one tarball and extracted into a staged copy of the conf dir,
+    which is checked with `nginx -t`. Only a valid config is moved into
+    place, then nginx is reloaded gracefully with HUP if it is running, so
+    an invalid config is never seen by nginx. Returns the list of changed
+    paths."""
+    version = get_config()['version']
 
     install_dir = os.path.join(_INSTALL_DIR, 'nginx', version)
-    conf_file = os.path.join(install_dir, 'conf', 'sites-enabled', site_name)
+    conf_dir = os.path.join(install_dir, 'conf')
+    nginx_bin = os.path.join(install_dir, 'sbin', 'nginx')
+    nginx_pid = os.path.join(install_dir, 'logs', 'nginx.pid')
+
+    confs = [(path, _to_bytes(content)) for path, content in confs]
+    with fab.settings(fab.hide('everything'), warn_only=True), fab.cd(conf_dir):
+        output = fab.sudo('md5sum {0} 2>/dev/null'.format(' '.join(path for path, content in confs)))
+    remote_md5 = dict(reversed(line.split(None, 1)) for line in str(output).splitlines() if line.strip())
+
+    changed = [(path, content) for path, content in confs
+               if remote_md5.get(path) != hashlib.md5(content).hexdigest()]
+    if not changed:
+        fab.puts("Nginx configs are up to date")
+        return []
+
+    local_temp_dir = mkdtemp()
+    bundle = os.path.join(local_temp_dir, 'confs.tar')
+    with closing(tarfile.open(bundle, 'w')) as tar:
+        for path, content in changed:
+            info = tarfile.TarInfo(path)
+            info.size, info.mode, info.mtime = len(content), 0o644, time.time()
+            tar.addfile(info, BytesIO(content))
+    remote_bundle = '/tmp/fabix-nginx-confs-{0}.tar'.format(
+        hashlib.md5(b''.join(content for path, content in changed)).hexdigest())
+    fab.put(bundle, remote_bundle)
+    fab.local('rm -rf {0}'.format(local_temp_dir))
+
+    paths = ' '.join(path for path, content in changed)
+    fab.puts("Installing nginx configs {0}".format(paths))
+    # the staged copy sits next to conf/ so files are moved in with rename
+    script = (
+        'cd {install_dir} && exec 9>>.fabix-conf.lock && flock 9 && '
+        'stage=$(mktemp -d .conf.XXXXXX) && cp -a conf/. "$stage" && '
+        'tar xf {bundle} --no-same-owner -C "$stage" && rm -f {bundle} && '
+        'if {nginx_bin} -t -q -c "{install_dir}/$stage/nginx.conf"; then '
+        'for f in {paths}; do mkdir -p "$(dirname "conf/$f")" && mv -f "$stage/$f" "conf/$f" || exit 1; done; '
+        'rm -rf "$stage"; '
+        'if [ -s {pid} ] && kill -0 $(cat {pid}) 2>/dev/null; then kill -HUP $(cat {pid}); fi; '
+        'else rm -rf "$stage"; echo "Invalid nginx config, nothing installed" >&2; exit 1; fi'
+    )
+    fab.sudo(script.format(install_dir=install_dir, paths=paths, bundle=remote_bundle, nginx_bin=nginx_bin,
+                           pid=nginx_pid))
+
+    return [path for path, content in changed]
+
+
+def _to_bytes(content):
+    if isinstance(content, bytes):
+        return content
+    return content.encode('utf-8')
+
+
+def upstream_conf(name, servers, port=80, keepalive=32, weight=1, max_fails=3, fail_timeout='10s'):
+    """Return an nginx `upstream` block named `name` for `servers`.
+
+    `keepalive` idle connections to the backends are kept open per worker."""
+    lines = ['upstream {0} {{'.format(name)]
+    for server in sorted(servers):
+        lines.append('    server {0}:{1} weight={2} max_fails={3} fail_timeout={4};'.format(
+                     server, port, weight, max_fails, fail_timeout))
+    if int(keepalive):
+        lines.append('    keepalive {0};'.format(keepalive))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
 
-    if context:
-        tpl_content = open(nginx_file, 'rb').read()
-        content = cuisine.text_template(tpl_content, context)
 
-        with cuisine.mode_sudo():
-            cuisine.file_write(conf_file, content)
-    else:
-        with cuisine.mode_sudo():
-            cuisine.file_upload(conf_file, nginx_file)
+@fab.task
+def put_upstream(name, elb_name, port=80, keepalive=32, weight=1, max_fails=3, fail_timeout='10s',
+                 attribute='private_ip_address'):
+    """Install an upstream `name` with the instances behind ELB `elb_name`.
+
+    The block is written to sites-enabled/`name`.upstream and nginx is
+    reloaded only if the instance list changed. Sites can then
+    `proxy_pass http://name;`. Keepalive needs HTTP/1.1 without a
+    `Connection` header to the backends, which the default nginx.conf sets
+    for locations that don't set their own proxy headers."""
+    from fabix.aws import ec2
+
+    servers = ec2.get_autoscaling_instances(elb_name, attribute)
+    if not servers:
+        fab.abort("No running instances behind {0}".format(elb_name))
+
+    fab.puts("Upstream {0}: {1}".format(name, ' '.join(sorted(servers))))
+    content = upstream_conf(name, servers, port, keepalive, weight, max_fails, fail_timeout)
+    return push_confs([(os.path.join('sites-enabled', '{0}.upstream'.format(name)), content)])
 
 
 @fab.task
 def setup(nginx_file, nginx_site_conf):
-    """Installs and configures nginx"""
+    """Installs and configures nginx
+
+    Pass an empty `nginx_file` to use the default config sized for the host."""
     install()
     install_upstart()
     put_conf(nginx_file)
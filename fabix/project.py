@@ -1,13 +1,91 @@
 import os
+import socket
+import subprocess
 from datetime import datetime
 from tempfile import mkdtemp
 
-import cuisine
 import fabric.api as fab
+from fabric.network import prompt_for_password
+from fabric.state import connections
 
-from fabix import get_config
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+from fabix import assets, cache, get_config, trace
+from fabix.batch import batch
 
 INSTALL_DIR = '/data/sites'
+DELTA_MAX_FILES = 1000
+S3_URL_EXPIRES = 900
+MANIFEST = 'releases.manifest'
+
+# Keeps `INSTALL_DIR/<site>/releases.manifest` in sync with the releases
+# directory. Each line holds release, commit, upload time, size in KB and
+# active flag, ordered by upload time. Releases missing from the manifest
+# (uploaded by older fabix versions) are adopted using their mtime.
+_MANIFEST_AWK = r"""
+BEGIN { FS = OFS = "\t" }
+FILENAME == ARGV[1] {
+    if (!($1 in uploaded)) names[n++] = $1
+    commit[$1] = $2; uploaded[$1] = $3; size[$1] = $4
+    next
+}
+{
+    found[$1] = 1
+    if (!($1 in uploaded)) { names[n++] = $1; uploaded[$1] = int($2) }
+}
+END {
+    if (op == "upload") {
+        if (!(release in uploaded)) names[n++] = release
+        found[release] = 1; commit[release] = rcommit; uploaded[release] = rtime; size[release] = rsize
+    }
+    for (i = 0; i < n; i++) {
+        r = names[i]
+        if (!(r in found)) continue
+        for (j = m++; j > 0 && uploaded[sorted[j - 1]] + 0 > uploaded[r] + 0; j--) sorted[j] = sorted[j - 1]
+        sorted[j] = r
+    }
+    if (op == "activate") live = release
+    if (op == "rollback") {
+        target = ""
+        for (i = 1; i < m; i++) if (sorted[i] == live) target = sorted[i - 1]
+        if (target == "") { print "No release to roll back to" > "/dev/stderr"; exit 1 }
+        live = target
+        print target
+    }
+    if (op == "cleanup") {
+        for (i = m - 1; i >= 0; i--) {
+            if (m - 1 - i < keep + 0 || sorted[i] == live) continue
+            removed[sorted[i]] = 1
+            print sorted[i]
+        }
+    }
+    for (i = 0; i < m; i++) {
+        r = sorted[i]
+        if (r in removed) continue
+        print r, commit[r], uploaded[r], size[r], (r == live ? 1 : 0) > out
+    }
+}
+"""
+
+# Reads the tree list (`mode<TAB>path`) then the `find -printf '%y\t%m\t%P\n'`
+# listing of a delta release, writes the paths to remove to `tmp`/untracked
+# and the files to chmod to `tmp`/modes. Untracked files under `static`
+# are build output, which the archive has with mode 644.
+_DELTA_AWK = r'''
+BEGIN { FS = "\t" }
+NR == FNR { tracked[substr($0, length($1) + 2)] = $1; next }
+{
+    path = substr($0, length($1) + length($2) + 3)
+    if (path in tracked) mode = tracked[path]
+    else if (static != "" && index(path, static "/") == 1) mode = "644"
+    else mode = ""
+    if (mode == "") print path > (tmp "/untracked")
+    else if ($1 == "f" && mode != "link" && mode != $2) print mode "\t" path > (tmp "/modes")
+}
+'''
 
 
 class env(object):
@@ -25,78 +103,583 @@ class env(object):
             fab.env.fabix['_current_project'] = self._old_env_name
 
 
+def manifest_command(site, op, before='', after='', **params):
+    """Build a shell command applying `op` to the release manifest of `site`.
+
+    The manifest is rewritten atomically under a lock. `before` and `after`
+    are shell fragments (ending with `&& `) run around the manifest update;
+    `after` can use `$result`, which holds what the `op` printed."""
+    awk_vars = ''.join('-v {0}={1} '.format(name, value) for name, value in sorted(params.items()))
+    cmd = (
+        'cd {site_dir} && mkdir -p releases && touch {manifest} && '
+        'exec 9>>.{manifest}.lock && flock 9 && {before}'
+        'live=$(readlink {site} || true) && live=${{live##*/}} && '
+        'result=$(find releases -mindepth 1 -maxdepth 1 -type d -printf \'%f\\t%T@\\n\' | '
+        'awk -v op={op} -v live="$live" -v out={manifest}.tmp {awk_vars}{program} {manifest} -) && '
+        '{after}mv {manifest}.tmp {manifest} && echo "$result"'
+    )
+    return cmd.format(site_dir=quote(os.path.join(INSTALL_DIR, site)), site=quote(site), manifest=MANIFEST,
+                      op=op, before=before, after=after, awk_vars=awk_vars, program=quote(_MANIFEST_AWK))
+
+
+def _manifest_upload_command(site, current, commit_id=None):
+    release_dir = quote(os.path.join('releases', current))
+    return manifest_command(
+        site, 'upload',
+        before='[ -d {0} ] && size=$(du -sk {0} | cut -f1) && '.format(release_dir),
+        release=quote(current), rcommit=quote(commit_id or current[-8:]),
+        rtime='"$(date +%s)"', rsize='"$size"')
+
+
+@fab.task
+def upload(tag='master', stream=False, delta=False, s3=False):
+    """Upload project `site` files from tag or branch `master`.
+
+    If `stream` is set, `git archive` output is piped over SSH straight into
+    the release directory instead of going through temporary files. If
+    `delta` is set, only files changed since the active release are sent.
+    If `s3` is set, the host downloads the archive from S3 (see
+    `upload_all`)."""
+    if s3:
+        local_temp_dir, archive, current = do_archive(tag)
+        commit_id = str(fab.local('git rev-parse {0}'.format(tag), True)).strip()
+        try:
+            key_name, sha256 = put_s3_archive(archive, commit_id)
+            return do_s3_upload(key_name, sha256, current, commit_id=commit_id)
+        finally:
+            if local_temp_dir:
+                fab.local('rm -rf {0}'.format(local_temp_dir))
+
+    if delta:
+        commit_id, current = release_name(tag)
+        return do_delta_upload(current, commit_id)
+
+    if stream:
+        commit_id, current = release_name(tag)
+        archive = cached_archive(commit_id)
+        return do_stream_upload(current, commit_id=commit_id, archive=archive)
+
+    local_temp_dir, archive, current = do_archive(tag)
+    commit_id = str(fab.local('git rev-parse {0}'.format(tag), True)).strip()
+    return do_upload(local_temp_dir, archive, current, commit_id=commit_id)
+
+
 @fab.task
-def upload(tag='master'):
-    """Upload project `site` files from tag or branch `master`."""
+@fab.runs_once
+def upload_all(tag='master', pool_size=10, stream=False, delta=False, s3=False):
+    """Upload project `site` files from tag or branch `master` to all hosts.
+
+    The archive is built only once and shipped to up to `pool_size` hosts in
+    parallel, so every host gets the same release name. With `s3` the
+    archive is uploaded once to the project `s3_bucket` and hosts download
+    it themselves, so the local uplink is used only once. Returns a dict
+    mapping each host to its uploaded release."""
     local_temp_dir, archive, current = do_archive(tag)
-    return do_upload(local_temp_dir, archive, current)
+    commit_id = str(fab.local('git rev-parse {0}'.format(tag), True)).strip()
 
+    if s3:
+        upload_task = fab.parallel(pool_size=int(pool_size))(do_s3_upload)
+        key_name, sha256 = put_s3_archive(archive, commit_id)
+        args, kwargs = (key_name, sha256, current), dict(commit_id=commit_id)
+    elif delta:
+        upload_task = fab.parallel(pool_size=int(pool_size))(do_delta_upload)
+        args, kwargs = (current, commit_id), dict(archive=archive)
+    elif stream:
+        upload_task = fab.parallel(pool_size=int(pool_size))(do_stream_upload)
+        args, kwargs = (current,), dict(commit_id=commit_id, archive=archive)
+    else:
+        upload_task = fab.parallel(pool_size=int(pool_size))(do_upload)
+        args, kwargs = (local_temp_dir, archive, current), dict(cleanup=False, commit_id=commit_id)
 
-def do_upload(local_temp_dir, archive, current):
+    try:
+        return fab.execute(upload_task, *args, **kwargs)
+    finally:
+        if local_temp_dir:
+            fab.local('rm -rf {0}'.format(local_temp_dir))
+
+
+def do_upload(local_temp_dir, archive, current, cleanup=True, commit_id=None):
     site = fab.env.fabix['_current_project']
     release_dir = os.path.join(INSTALL_DIR, site, 'releases')
 
-    with cuisine.mode_sudo():
-        cuisine.dir_ensure(release_dir)
-
-    with fab.lcd(local_temp_dir):
-        remote_temp_dir = fab.run('mktemp -d')
-        fab.put(archive, remote_temp_dir)
-        with fab.cd(remote_temp_dir):
-            fab.run("tar xzf {0}.tar.gz".format(site))
-            fab.run("rm -f {0}.tar.gz".format(site))
-        fab.sudo('chown -R root.root {0}'.format(remote_temp_dir))
-        fab.sudo('chmod -R 755 {0}'.format(remote_temp_dir))
-        fab.sudo("mv {tmp_dir} {release_dir}/{current}".format(release_dir=release_dir, current=current, tmp_dir=remote_temp_dir))
-        fab.run('rm -rf {0}'.format(remote_temp_dir))
-    fab.local('rm -rf {0}'.format(local_temp_dir))
+    remote_archive = '/tmp/fabix-{0}-{1}.tar.gz'.format(site, current)
+    fab.put(archive, remote_archive)
+
+    with batch(use_sudo=True) as cmds:
+        cmds.run('mkdir -p {0}'.format(release_dir))
+        cmds.run('tmp_dir=$(mktemp -d)')
+        cmds.run('tar xzf {0} -C "$tmp_dir"'.format(remote_archive))
+        cmds.run('rm -f {0}'.format(remote_archive))
+        cmds.run('chown -R root.root "$tmp_dir"')
+        cmds.run('chmod -R 755 "$tmp_dir"')
+        cmds.run('mv "$tmp_dir" {release_dir}/{current}'.format(release_dir=release_dir, current=current))
+        cmds.run(_manifest_upload_command(site, current, commit_id))
+    if cleanup and local_temp_dir:
+        fab.local('rm -rf {0}'.format(local_temp_dir))
 
     return current
 
 
-def do_archive(tag='master'):
+def put_s3_archive(archive, commit_id):
+    """Upload release `archive` to S3 unless already there.
+
+    The key lives in the project `s3_bucket` under `s3_prefix` (`releases`
+    by default). Returns the full key name and the archive sha256."""
+    from fabix.aws import s3
+
+    site = fab.env.fabix['_current_project']
+    config = get_config()
+
+    sha256 = cache.file_digest(archive)
+
+    bucket = s3.connect().get_bucket(config['s3_bucket'], validate=False)
+    key_name = '{0}/{1}-{2}.tar.gz'.format(site, commit_id, sha256[:12])
+    key = s3.upload_file(bucket, key_name, archive, remote_prefix=config.get('s3_prefix', 'releases'),
+                         policy='private')
+    return key.name, sha256
+
+
+def do_s3_upload(key_name, sha256, current, commit_id=None):
+    """Download release `current` from S3 key `key_name` on the remote host.
+
+    Each host gets its own URL, signed right before the download and valid
+    for `S3_URL_EXPIRES` seconds, so hosts started late in a large parallel
+    deploy don't get an expired one. The URL is handed over in the
+    environment, so it doesn't show up in the logged commands. The download
+    is checked against `sha256` before it is extracted."""
+    from fabix.aws import s3
+
+    site = fab.env.fabix['_current_project']
+    release_dir = os.path.join(INSTALL_DIR, site, 'releases')
+
+    bucket = s3.connect().get_bucket(get_config()['s3_bucket'], validate=False)
+    url = bucket.new_key(key_name).generate_url(S3_URL_EXPIRES)
+
+    fab.puts("Downloading release {0} on {1}".format(current, fab.env.host_string))
+    with fab.shell_env(FABIX_RELEASE_URL=url), batch(use_sudo=True) as cmds:
+        cmds.run('mkdir -p {0}'.format(release_dir))
+        cmds.run('tmp_dir=$(mktemp -d)')
+        cmds.run('wget -q "$FABIX_RELEASE_URL" -O "$tmp_dir.tar.gz" && '
+                 'echo "{sha256}  $tmp_dir.tar.gz" | sha256sum -c --quiet - '
+                 '|| {{ rm -rf "$tmp_dir" "$tmp_dir.tar.gz"; false; }}'.format(sha256=sha256))
+        cmds.run('tar xzf "$tmp_dir.tar.gz" -C "$tmp_dir"')
+        cmds.run('rm -f "$tmp_dir.tar.gz"')
+        cmds.run('chown -R root.root "$tmp_dir"')
+        cmds.run('chmod -R 755 "$tmp_dir"')
+        cmds.run('mv "$tmp_dir" {release_dir}/{current}'.format(release_dir=release_dir, current=current))
+        cmds.run(_manifest_upload_command(site, current, commit_id))
+
+    return current
+
+
+def do_stream_upload(current, commit_id=None, archive=None):
+    """Extract release `current` on the remote host straight from a pipe.
+
+    The tarball comes from `archive` if given, otherwise from `git archive`
+    of `commit_id`. It is extracted by root into its final directory, so
+    files are owned by root and keep the modes git recorded (644 or 755).
+    The data goes over the host's Fabric connection (see `pipe_to_host`)."""
+    site = fab.env.fabix['_current_project']
+    release_dir = os.path.join(INSTALL_DIR, site, 'releases', current)
+
+    local_temp_dir = None
+    if archive is None and get_config().get('static_dir'):
+        local_temp_dir, archive = build_archive(commit_id)
+
+    if archive is not None:
+        source_cmd = 'cat {0}'.format(quote(archive))
+    else:
+        project_dir = get_config()['project_dir']
+        source_cmd = "git -c tar.umask=0022 archive --format=tar.gz {commit_id}:{project_dir}".format(
+            commit_id=commit_id, project_dir=project_dir)
+
+    script = ("mkdir -p {dir} && tar xzf - --no-same-owner -C {dir} "
+              "|| {{ rm -rf {dir}; exit 1; }}").format(dir=quote(release_dir))
+    script += ' && ' + _manifest_upload_command(site, current, commit_id)
+
+    fab.puts("Streaming release {0} to {1}".format(current, fab.env.host_string))
+    try:
+        pipe_to_host(source_cmd, script)
+    finally:
+        if local_temp_dir:
+            fab.local('rm -rf {0}'.format(local_temp_dir))
+
+    return current
+
+
+def do_delta_upload(current, commit_id, archive=None):
+    """Upload release `current` as a delta against the active release.
+
+    The new release directory is seeded with hardlinks to the active release,
+    then matched against the tree of `commit_id`: files it doesn't track
+    (deleted ones, bytecode, anything written by the app) are removed and
+    files with another mode are replaced by copies with the tracked mode, so
+    the result is the same as a full upload. Built files under `static_dir`
+    are kept, as a full upload would build them again the same way. Only
+    added or changed files are streamed. Falls back to a full streamed upload
+    (of `archive` if given) when there is no usable previous release."""
     site = fab.env.fabix['_current_project']
     project_dir = get_config()['project_dir']
+    releases_dir = os.path.join(INSTALL_DIR, site, 'releases')
 
-    install_dir = os.path.join(INSTALL_DIR, site)
-    dirs_to_create = (
-        os.path.join(install_dir, 'releases'),
-    )
-    fab.sudo('mkdir -p {0}'.format(' '.join(dirs_to_create)))
+    previous = _active_release(site)
+    previous_commit = None
+    if previous:
+        with fab.settings(fab.hide('everything'), warn_only=True):
+            previous_commit = fab.local('git rev-parse --verify -q {0}^{{commit}}'.format(previous[-8:]), True)
+        if previous_commit.failed:
+            previous_commit = None
 
-    fab.puts("Upload project {0}".format(site))
+    if not previous_commit:
+        fab.puts("No previous release found for delta, uploading full release")
+        return do_stream_upload(current, commit_id=commit_id, archive=archive)
+
+    changed, deleted = _tree_changes(str(previous_commit).strip(), commit_id, project_dir)
+    if len(changed) + len(deleted) > DELTA_MAX_FILES:
+        fab.puts("Too many changes for delta, uploading full release")
+        return do_stream_upload(current, commit_id=commit_id, archive=archive)
+
+    static_dir = get_config().get('static_dir')
+    if static_dir and any(_is_under(path, static_dir) for path in changed + deleted):
+        fab.puts("Static files changed, uploading full release with rebuilt assets")
+        return do_stream_upload(current, commit_id=commit_id, archive=archive)
+
+    tree = _tree_files(commit_id, project_dir)
+    if any('\n' in path for path in tree):
+        fab.puts("File names with newlines can't be listed for delta, uploading full release")
+        return do_stream_upload(current, commit_id=commit_id, archive=archive)
+
+    with fab.settings(fab.hide('everything')):
+        remote_temp_dir = str(fab.run('mktemp -d')).strip()
+    local_temp_dir = mkdtemp()
+    tree_list = os.path.join(local_temp_dir, 'tree')
+    with open(tree_list, 'wb') as fd:
+        for path, (mode, size) in sorted(tree.items()):
+            fd.write('{0}\t{1}\n'.format(mode, path).encode('utf-8'))
+    fab.put(tree_list, remote_temp_dir)
+    fab.local('rm -rf {0}'.format(local_temp_dir))
+
+    release_dir = os.path.join(releases_dir, current)
+    static_prefix = os.path.normpath(static_dir) if static_dir else ''
+    script = [
+        'cp -al {0} {1}'.format(quote(os.path.join(releases_dir, previous)), quote(release_dir)),
+        'cd {0}'.format(quote(release_dir)),
+        ': > {0}/untracked && : > {0}/modes'.format(quote(remote_temp_dir)),
+        "find . ! -type d -printf '%y\\t%m\\t%P\\n' | awk -v tmp={tmp} -v static={static} {awk} {tmp}/tree -".format(
+            tmp=quote(remote_temp_dir), static=quote(static_prefix), awk=quote(_DELTA_AWK)),
+        "tr '\\n' '\\0' < {0}/untracked | xargs -0 -r rm -f --".format(quote(remote_temp_dir)),
+        # the files are hardlinks to the previous release: chmod a copy
+        '{{ while IFS="$(printf \'\\t\')" read -r mode path; do '
+        'cp -p -- "$path" "$path.fabix-tmp" && chmod "$mode" "$path.fabix-tmp" '
+        '&& mv -f -- "$path.fabix-tmp" "$path" || exit 1; done < {0}/modes; }}'.format(quote(remote_temp_dir)),
+        'find . -mindepth 1 -depth -type d -empty -delete',
+    ]
+    if changed:
+        script.append('tar xzf - --no-same-owner')
+
+    script = '( {0} ) || {{ rm -rf {1}; exit 1; }}'.format(' && '.join(script), quote(release_dir))
+    script += ' && ' + _manifest_upload_command(site, current, commit_id)
 
+    source_cmd = None
+    if changed:
+        source_cmd = "git -c tar.umask=0022 archive --format=tar.gz {commit_id}:{project_dir} -- {paths}".format(
+            commit_id=commit_id, project_dir=project_dir,
+            paths=' '.join(quote(path) for path in changed))
+
+    fab.puts("Uploading release {0} as delta against {1}".format(current, previous))
+    try:
+        pipe_to_host(source_cmd, script)
+    finally:
+        with fab.settings(fab.hide('everything'), warn_only=True):
+            fab.sudo('rm -rf {0}'.format(quote(remote_temp_dir)))
+
+    total = sum(size for mode, size in tree.values())
+    sent = sum(tree[path][1] for path in changed if path in tree)
+    fab.puts("Delta upload sent {0} changed and {1} deleted files, saved {2} of {3} bytes".format(
+        len(changed), len(deleted), total - sent, total))
+
+    return current
+
+
+def _is_under(path, directory):
+    directory = os.path.normpath(directory)
+    return directory in ('', '.') or os.path.normpath(path).startswith(directory + os.sep)
+
+
+def _active_release(site):
+    """Return the name of the release currently active for `site`, if any."""
+    with fab.settings(fab.hide('everything'), warn_only=True):
+        link = fab.run('readlink {0}'.format(os.path.join(INSTALL_DIR, site, site)))
+    if link.failed or not link.strip():
+        return None
+    return os.path.basename(str(link).strip())
+
+
+def _tree_changes(old_commit, new_commit, project_dir):
+    """Return paths under `project_dir` changed and deleted between commits."""
+    relative = ''
+    if project_dir.strip('/') not in ('', '.'):
+        relative = '--relative={0}/'.format(project_dir.strip('/'))
+
+    cmd = 'git diff --name-status --no-renames --no-ext-diff -z {relative} {old} {new}'
+    out = str(fab.local(cmd.format(relative=relative, old=old_commit, new=new_commit), True))
+
+    changed, deleted = [], []
+    fields = [field for field in out.split('\0') if field]
+    for status, path in zip(fields[0::2], fields[1::2]):
+        if status.startswith('D'):
+            deleted.append(path)
+        else:
+            changed.append(path)
+    return changed, deleted
+
+
+def _tree_files(commit_id, project_dir):
+    """Return a dict with the mode (as `find -printf %m` shows it, or
+    `link`) and blob size of each file under `project_dir`."""
+    out = str(fab.local('git ls-tree -r -l -z {0}:{1}'.format(commit_id, project_dir), True))
+
+    files = {}
+    for entry in out.split('\0'):
+        if not entry:
+            continue
+        info, path = entry.split('\t', 1)
+        mode, size = info.split()[0], info.split()[3]
+        files[path] = ('link' if mode == '120000' else mode[-3:], int(size) if size.isdigit() else 0)
+    return files
+
+
+def pipe_to_host(source_cmd, script):
+    """Run shell `script` as root on the current host, fed the output of
+    local command `source_cmd` (or nothing) on its standard input.
+
+    The data goes through the host's Fabric connection, so the host string,
+    ssh config, keys, passwords and gateway work as for any other task. As
+    there is no terminal, a sudo password (`sudo_password` or `password`,
+    prompted for if unset) is sent ahead of the data when sudo needs one.
+    Returns the script output."""
+    transport = connections[fab.env.host_string].get_transport()
+
+    password = None
+    check = transport.open_session()
+    check.exec_command('sudo -n true')
+    if check.recv_exit_status() != 0:
+        password = fab.env.sudo_password or fab.env.password
+        if not password:
+            password = prompt_for_password("[{0}] sudo password".format(fab.env.host_string))
+            fab.env.sudo_password = password
+
+    channel = transport.open_session()
+    channel.exec_command("sudo -S -p '' sh -c {0}".format(quote(script)))
+    with trace.span('pipe {0}'.format((source_cmd or 'nothing')[:200]), 'transfer') as attrs:
+        if password:
+            channel.sendall((password + '\n').encode('utf-8'))
+        sent = 0
+        if source_cmd:
+            source = subprocess.Popen(source_cmd, shell=True, stdout=subprocess.PIPE)
+            try:
+                for chunk in iter(lambda: source.stdout.read(64 * 1024), b''):
+                    channel.sendall(chunk)
+                    sent += len(chunk)
+            except socket.error:
+                # the script stopped reading, its exit status tells why
+                pass
+            finally:
+                source.stdout.close()
+                source.wait()
+        channel.shutdown_write()
+        output = channel.makefile('rb').read().decode('utf-8', 'replace')
+        errors = channel.makefile_stderr('rb').read().decode('utf-8', 'replace')
+        status = channel.recv_exit_status()
+        attrs.update(bytes_sent=sent, status=status)
+
+    if source_cmd and source.returncode:
+        fab.abort("Local command failed with exit code {0}: {1}".format(source.returncode, source_cmd))
+    if status:
+        fab.abort("Remote command failed with exit code {0}:\n{1}".format(status, errors))
+    return output
+
+
+def release_name(tag='master'):
+    """Return the full commit id for `tag` and the release name built from it."""
     today = datetime.now().strftime('%Y%m%d-%H%M%S')
     commit_id = str(fab.local('git rev-parse {0}'.format(tag), True)).strip()
     current = "%s-%s" % (today, commit_id[:8])
+    return commit_id, current
+
+
+def do_archive(tag='master'):
+    site = fab.env.fabix['_current_project']
+
+    fab.puts("Upload project {0}".format(site))
+
+    commit_id, current = release_name(tag)
+    local_temp_dir, archive = build_archive(commit_id)
+    return local_temp_dir, archive, current
+
+
+def build_archive(commit_id):
+    """Build the release archive of `commit_id`, or take it from the cache.
+
+    If the project sets `static_dir` (relative to `project_dir`), static
+    files are fingerprinted and precompressed into the archive (see
+    `fabix.assets`). Returns the temporary directory to remove afterwards
+    (None for a cached archive) and the archive path."""
+    site = fab.env.fabix['_current_project']
+    config = get_config()
+    project_dir = config['project_dir']
+
+    archive = cached_archive(commit_id)
+    if archive:
+        fab.puts("Using cached archive for commit {0}".format(commit_id[:8]))
+        return None, archive
 
     local_temp_dir = mkdtemp()
     archive = os.path.join(local_temp_dir, '{0}.tar.gz'.format(site))
 
-    git_arch_cmd = "git archive --format=tar.gz -o {archive} {commit_id}:{project_dir}"
-    fab.local(git_arch_cmd.format(archive=archive, commit_id=commit_id, project_dir=project_dir))
+    level = config.get('archive_compression')
+    level = '-{0}'.format(level) if level else ''
+    if config.get('static_dir'):
+        build_dir = os.path.join(local_temp_dir, 'build')
+        os.makedirs(build_dir)
+        fab.local("git -c tar.umask=0022 archive --format=tar {commit_id}:{project_dir} | tar xf - -C {dir}".format(
+                  commit_id=commit_id, project_dir=project_dir, dir=build_dir))
+        assets.build(os.path.join(build_dir, config['static_dir']),
+                     use_brotli=config.get('static_brotli', False))
+        fab.local("tar cf - -C {dir} . | gzip {level} > {archive}".format(dir=build_dir, level=level, archive=archive))
+        fab.local('rm -rf {0}'.format(build_dir))
+    else:
+        git_arch_cmd = "git -c tar.umask=0022 archive --format=tar.gz {level} -o {archive} {commit_id}:{project_dir}"
+        fab.local(git_arch_cmd.format(archive=archive, commit_id=commit_id, project_dir=project_dir, level=level))
 
-    return local_temp_dir, archive, current
+    archive_key = _archive_key(commit_id)
+    if archive_key:
+        archive = cache.store('archives', archive_key, archive, '.tar.gz')
+        fab.local('rm -rf {0}'.format(local_temp_dir))
+        local_temp_dir = None
+
+    return local_temp_dir, archive
+
+
+def cached_archive(commit_id):
+    """Return the cached release archive for `commit_id` or None."""
+    archive_key = _archive_key(commit_id)
+    if not archive_key:
+        return None
+    return cache.lookup('archives', archive_key, '.tar.gz')
+
+
+def _archive_key(commit_id):
+    config = get_config()
+    if not config.get('archive_cache', True):
+        return None
+    return cache.cache_key(commit_id, config['project_dir'], 'tar.gz', config.get('archive_compression'),
+                           config.get('static_dir'), config.get('static_brotli', False))
 
 
 @fab.task
-def activate(release):
-    """Activate release `release` code for project `project`."""
+def warmup(release, workers=None):
+    """Byte-compile release `release` and run warmup hooks for project `project`."""
+    do_warmup(release, workers)
+
+
+def do_warmup(release, workers=None):
+    """Prepare release `release` to serve requests as soon as it is activated.
+
+    Python files are compiled by `workers` parallel processes (one per core
+    by default) with the interpreter of the release virtualenv, or of the
+    shared project virtualenv if the release has none. Then every hook
+    in the project `warmup_hooks` setting runs, in order. A hook is either a
+    callable receiving the release directory or a shell command run from it,
+    formatted with `release_dir` and `python`. A failing command hook aborts,
+    so a broken release is never activated."""
     project = fab.env.fabix['_current_project']
+    release_dir = os.path.join(INSTALL_DIR, project, 'releases', release)
+    python_bin = os.path.join(INSTALL_DIR, project, 'virtualenvs', release, 'bin', 'python')
+    with fab.settings(fab.hide('everything'), warn_only=True):
+        if fab.run('test -x {0}'.format(python_bin)).failed:
+            python_bin = os.path.join(INSTALL_DIR, project, 'virtualenv', 'bin', 'python')
+
+    fab.puts("Warming up project {0} release {1}".format(project, release))
+    # py_compile rewrites existing .pyc files in place, which would write
+    # through hardlinks shared with other releases: remove them first
+    compile_cmd = ("find {release_dir} -name '*.py[co]' -delete && "
+                   "find {release_dir} -name '*.py' -print0 | xargs -0 -r -n 100 -P {workers} {python} -m py_compile")
+    with fab.settings(warn_only=True):
+        result = fab.sudo(compile_cmd.format(release_dir=release_dir, python=python_bin,
+                                             workers=int(workers) if workers else '$(nproc)'))
+    if result.failed:
+        fab.warn("Some files of release {0} could not be byte-compiled".format(release))
+
+    with fab.cd(release_dir):
+        for hook in get_config().get('warmup_hooks', []):
+            if callable(hook):
+                hook(release_dir)
+            else:
+                fab.sudo(hook.format(release_dir=release_dir, python=python_bin))
+
+
+@fab.task
+def activate(release, warmup=False):
+    """Activate release `release` code for project `project`.
+
+    If `warmup` or the project `warmup` setting is set, the release is warmed
+    up before the symlink is switched. If the release has its own virtualenv,
+    the `virtualenv` symlink is switched to it in the same step; a shared
+    virtualenv left by older deploys is moved aside to `virtualenv.shared`."""
+    project = fab.env.fabix['_current_project']
+
+    if warmup or get_config().get('warmup'):
+        do_warmup(release)
 
     fab.puts("Activating project {0} release {1}".format(project, release))
-    with fab.cd(os.path.join(INSTALL_DIR, project)):
-        fab.sudo("ln -nsf releases/{release} {project}".format(project=project, release=release))
+    fab.sudo(manifest_command(
+        project, 'activate',
+        before='[ -d {0} ] && '.format(quote(os.path.join('releases', release))),
+        after=(_switch_link_command(project, quote(os.path.join('releases', release))) +
+               _switch_virtualenv_command(quote(os.path.join('virtualenvs', release)))),
+        release=quote(release)))
+
+
+@fab.task
+def rollback():
+    """Activate the release uploaded before the active one for project `project`."""
+    project = fab.env.fabix['_current_project']
+
+    release = fab.sudo(manifest_command(
+        project, 'rollback',
+        after=_switch_link_command(project, '"releases/$result"') + _switch_virtualenv_command('"virtualenvs/$result"')))
+    fab.puts("Rolled back project {0} to release {1}".format(project, release))
+    return str(release)
+
+
+def _switch_link_command(project, target):
+    """Shell fragment atomically pointing the `project` symlink to `target`."""
+    return 'ln -sfn {target} .{project}.tmp && mv -T .{project}.tmp {project} && '.format(
+        target=target, project=quote(project))
+
+
+def _switch_virtualenv_command(target):
+    """Shell fragment pointing the `virtualenv` symlink to `target`, if it exists."""
+    return ('if [ -d {target} ]; then {{ [ -L virtualenv ] || [ ! -e virtualenv ] || '
+            'mv virtualenv virtualenv.shared; }} && ln -sfn {target} .virtualenv.tmp && '
+            'mv -T .virtualenv.tmp virtualenv; fi && ').format(target=target)
 
 
 @fab.task
 def cleanup(keep=5):
-    """Cleanup old releases for `site` keeping the `keep` most recent."""
+    """Cleanup old releases for `site` keeping the `keep` most recent.
+
+    The active release is never removed. Release virtualenvs go with their
+    releases, except the one the `virtualenv` symlink points to, which may
+    belong to an older release than the active one."""
     site = fab.env.fabix['_current_project']
 
-    with fab.cd(os.path.join(INSTALL_DIR, site, 'releases')):
-        files_to_remove = str(fab.run('ls -1')).split()
-        if files_to_remove:
-            cmd_args = ' '.join(files_to_remove[:-keep])
-            fab.puts("Removing releases {0}".format(cmd_args))
-            fab.sudo('rm -rf {0}'.format(cmd_args))
+    removed = fab.sudo(manifest_command(
+        site, 'cleanup',
+        after=('live_env=$(readlink virtualenv || true) && live_env=${live_env##*/} && '
+               'for release in $result; do rm -rf "releases/$release" && '
+               '{ [ "$release" = "$live_env" ] || rm -rf "virtualenvs/$release"; }; done && '),
+        keep=int(keep)))
+    if removed:
+        fab.puts("Removed releases {0}".format(' '.join(str(removed).split())))
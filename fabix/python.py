@@ -1,15 +1,26 @@
+import hashlib
 import os
+import re
 from functools import partial
+from tempfile import mkdtemp
 
 import cuisine
 import fabric.api as fab
 
-from fabix import get_config, get_project_name
+from fabix import cache, get_config, get_project_name, mirror
+from fabix.batch import batch
+from fabix.system import facts
 
 _INSTALL_DIR = '/opt'
 PYTHON_DOWNLOAD_URL = 'http://www.python.org/ftp/python/{version}/Python-{version}.tgz'
 SETUPTOOLS_DOWNLOAD_URL = 'http://pypi.python.org/packages/source/s/setuptools/setuptools-0.6c11.tar.gz'
 SITES_DIR = '/data/sites/'
+CCACHE_DIR = '/var/cache/ccache'
+WHEELHOUSE_DIR = '/var/cache/fabix/wheelhouse'
+BENCHMARK_SCRIPT = os.path.join(os.path.dirname(__file__), 'support_files', 'bench', 'pybench.py')
+_ARTIFACT_MARKER = '.fabix-artifact'
+_REQUIREMENTS_MARKER = '.fabix-requirements'
+_REQUIREMENTS_COPY = '.fabix-requirements.txt'
 
 
 get_proj_config = get_config
@@ -19,30 +30,196 @@ get_config = partial(get_config, 'python')
 @fab.task
 def install(force=False):
     """Install python"""
+    if get_config().get('artifact'):
+        return install_artifact(force)
+
     version = get_config()['version']
 
     install_dir = os.path.join(_INSTALL_DIR, 'python', version)
     python_bin = os.path.join(install_dir, 'bin', 'python')
 
-    if cuisine.file_exists(python_bin):
+    if facts.file_exists(python_bin):
         if not force:
             fab.puts("Python {0} found, skipping installation".format(version))
             return
         else:
             fab.puts("Reinstalling Python {0} found".format(version))
 
-    cuisine.package_install(['build-essential', 'libcurl4-openssl-dev'])
+    _build(version)
+
+
+def _build(version, install_dir=None, optimized=True):
+    """Compile python `version` into `install_dir`.
+
+    With `optimized` the build profile of the python section is applied:
+    `build_jobs` (number of make jobs, one per core by default),
+    `optimizations` (PGO), `lto`, `ccache` and extra `cflags`."""
+    install_dir = install_dir or os.path.join(_INSTALL_DIR, 'python', version)
+    config = get_config() if optimized else {}
+
+    packages = ['build-essential', 'libcurl4-openssl-dev']
+    if config.get('ccache'):
+        packages.append('ccache')
+    cuisine.package_install(packages)
+
+    build_env = _configure_env(config)
+    if config.get('ccache'):
+        fab.sudo('mkdir -p {0} && chmod 1777 {0}'.format(CCACHE_DIR))
+        build_env.update({'CC': 'ccache gcc', 'CCACHE_DIR': CCACHE_DIR})
+    jobs = config.get('build_jobs') or facts.get().get('cpu_count') or 1
 
     src_dir = fab.run('mktemp -d')
     with fab.cd(src_dir):
         fab.puts("Downloading python {0}".format(version))
-        fab.run("wget -q '%s' -O - | tar xz" % PYTHON_DOWNLOAD_URL.format(version=version))
-        with fab.cd('Python-{0}'.format(version)):
+        download_url = PYTHON_DOWNLOAD_URL.format(version=version)
+        with mirror.source(download_url, get_config().get('source_sha256')) as unpack_cmd:
+            fab.run(unpack_cmd)
+        with fab.cd('Python-{0}'.format(version)), fab.shell_env(**build_env):
             fab.puts("Installing python {0}".format(version))
-            fab.run("./configure --prefix=%s" % install_dir)
-            fab.run("make")
+            fab.run("./configure %s" % ' '.join(_configure_flags(install_dir, config)))
+            fab.run("make -j {0}".format(jobs))
             fab.sudo('make install')
     fab.run('rm -rf {0}'.format(src_dir))
+    facts.invalidate()
+
+
+def _configure_flags(install_dir, config=None):
+    config = get_config() if config is None else config
+
+    flags = ['--prefix={0}'.format(install_dir)]
+    if config.get('optimizations'):
+        flags.append('--enable-optimizations')
+    if config.get('lto'):
+        flags.append('--with-lto')
+    return flags
+
+
+def _configure_env(config=None):
+    config = get_config() if config is None else config
+
+    if config.get('cflags'):
+        return {'CFLAGS': config['cflags']}
+    return {}
+
+
+def _artifact_key(version, distro):
+    install_dir = os.path.join(_INSTALL_DIR, 'python', version)
+    return cache.cache_key(version, ' '.join(_configure_flags(install_dir)), sorted(_configure_env().items()), distro)
+
+
+@fab.task
+def build_artifact():
+    """Build python on this host and keep it in the local artifact cache.
+
+    The artifact is keyed by python version, configure flags and distro."""
+    version = get_config()['version']
+    install_dir = os.path.join(_INSTALL_DIR, 'python', version)
+
+    _build(version)
+
+    key = _artifact_key(version, facts.get()['distro'])
+    remote_artifact = '/tmp/fabix-python-{0}.tar.gz'.format(key)
+    fab.sudo("tar czf {0} --exclude {1} -C / {2}".format(
+             remote_artifact, _ARTIFACT_MARKER, install_dir.lstrip('/')))
+
+    local_temp_dir = mkdtemp()
+    local_artifact = os.path.join(local_temp_dir, 'python.tar.gz')
+    fab.get(remote_artifact, local_artifact)
+    fab.sudo('rm -f {0}'.format(remote_artifact))
+
+    artifact = cache.store('python', key, local_artifact, '.tar.gz')
+    fab.local('rm -rf {0}'.format(local_temp_dir))
+    return artifact
+
+
+@fab.task
+def install_artifact(force=False):
+    """Install python from a prebuilt artifact.
+
+    Missing artifacts are built on the `artifact_build_host` configured in
+    the python section. Installation is skipped when the host already has
+    the exact same artifact."""
+    version = get_config()['version']
+    install_dir = os.path.join(_INSTALL_DIR, 'python', version)
+    marker = os.path.join(install_dir, _ARTIFACT_MARKER)
+
+    key = _artifact_key(version, facts.get()['distro'])
+    artifact = cache.lookup('python', key, '.tar.gz')
+    if not artifact:
+        build_host = get_config().get('artifact_build_host')
+        if not build_host:
+            fab.abort("No python {0} artifact for this host and no artifact_build_host set".format(version))
+        fab.execute(build_artifact, hosts=[build_host])
+        artifact = cache.lookup('python', key, '.tar.gz')
+        if not artifact:
+            fab.abort("Build host {0} does not match the distro of {1}".format(build_host, fab.env.host_string))
+
+    digest = cache.file_digest(artifact, 'sha1')
+    with fab.settings(fab.hide('everything'), warn_only=True):
+        installed = fab.run('cat {0}'.format(marker))
+    if installed.succeeded and installed.strip() == digest:
+        if not force:
+            fab.puts("Python {0} artifact found, skipping installation".format(version))
+            return
+        else:
+            fab.puts("Reinstalling Python {0} artifact".format(version))
+
+    remote_artifact = '/tmp/fabix-python-{0}.tar.gz'.format(key)
+    fab.put(artifact, remote_artifact)
+
+    fab.puts("Installing python {0} artifact".format(version))
+    with batch(use_sudo=True) as cmds:
+        cmds.run("rm -rf '{0}'".format(install_dir))
+        cmds.run('tar xzf {0} -C /'.format(remote_artifact))
+        cmds.run('echo {0} > {1}'.format(digest, marker))
+        cmds.run('rm -f {0}'.format(remote_artifact))
+    facts.invalidate()
+
+
+@fab.task
+@fab.runs_once
+def install_artifact_all(force=False, pool_size=10):
+    """Install the python artifact on all hosts, `pool_size` at a time.
+
+    The first host goes alone so a missing artifact is built only once."""
+    hosts = fab.env.hosts
+    results = fab.execute(install_artifact, force, hosts=hosts[:1])
+    if hosts[1:]:
+        results.update(fab.execute(fab.parallel(pool_size=int(pool_size))(install_artifact), force,
+                                   hosts=hosts[1:]))
+    return results
+
+
+@fab.task
+def benchmark(baseline=None):
+    """Compare the configured python build against `baseline`.
+
+    `baseline` is the path of another interpreter. By default python is
+    also built without the build profile into /opt/python/<version>-baseline."""
+    version = get_config()['version']
+    python_bin = _python_bin_path(version)
+
+    if not baseline:
+        baseline_dir = os.path.join(_INSTALL_DIR, 'python', '{0}-baseline'.format(version))
+        baseline = os.path.join(baseline_dir, 'bin', 'python')
+        if not facts.file_exists(baseline):
+            fab.puts("Building baseline python {0}".format(version))
+            _build(version, baseline_dir, optimized=False)
+
+    remote_script = '/tmp/fabix-pybench.py'
+    fab.put(BENCHMARK_SCRIPT, remote_script)
+
+    timings = []
+    for interpreter in (baseline, python_bin):
+        with fab.settings(fab.hide('stdout')):
+            output = fab.run('{0} {1}'.format(interpreter, remote_script))
+        timings.append(dict(line.split() for line in str(output).splitlines() if line.strip()))
+    fab.run('rm -f {0}'.format(remote_script))
+
+    fab.puts("{0:<10} {1:>12} {2:>12} {3:>8}".format('test', 'baseline', 'configured', 'speedup'))
+    for name in sorted(timings[0]):
+        before, after = float(timings[0][name]), float(timings[1][name])
+        fab.puts("{0:<10} {1:>12.6f} {2:>12.6f} {3:>7.2f}x".format(name, before, after, before / after))
 
 
 def _python_bin_path(py_version, bin_name='python'):
@@ -56,7 +233,7 @@ def install_setuptools(force=False):
     py_version = get_config()['version']
 
     easy_install_bin = _python_bin_path(py_version, 'easy_install')
-    if cuisine.file_exists(easy_install_bin):
+    if facts.file_exists(easy_install_bin):
         if not force:
             fab.puts("easy_install for python {0} found, skipping installation".format(py_version))
             return
@@ -67,16 +244,17 @@ def install_setuptools(force=False):
     version = "{0}.{1}".format(major, minor)
 
     python_bin = _python_bin_path(py_version)
+    download_url = SETUPTOOLS_DOWNLOAD_URL.format(py_version=version)
 
-    src_dir = fab.run('mktemp -d')
-    with fab.cd(src_dir):
-        fab.puts("Downloading setuptools for python {0}".format(version))
-        download_url = SETUPTOOLS_DOWNLOAD_URL.format(py_version=version)
-        fab.run("wget -q '{0}' -O - | tar xz".format(download_url))
-        with fab.cd('setuptools-*'):
-            fab.puts("Installing setuptools for python {0}".format(version))
-            fab.sudo("{0} setup.py install".format(python_bin))
-    fab.sudo('rm -rf {0}'.format(src_dir))
+    fab.puts("Downloading and installing setuptools for python {0}".format(version))
+    with mirror.source(download_url, get_config().get('setuptools_sha256')) as unpack_cmd, \
+            batch(use_sudo=True) as cmds:
+        cmds.run('src_dir=$(mktemp -d) && cd "$src_dir"')
+        cmds.run(unpack_cmd)
+        cmds.run('cd setuptools-*')
+        cmds.run("{0} setup.py install".format(python_bin))
+        cmds.run('cd / && rm -rf "$src_dir"')
+    facts.invalidate()
 
 
 @fab.task
@@ -93,7 +271,8 @@ def uninstall_setuptools():
     with fab.cd(src_dir):
         fab.puts("Downloading setuptools for python {0}".format(version))
         download_url = SETUPTOOLS_DOWNLOAD_URL.format(py_version=version)
-        fab.run("wget -q '{0}' -O - | tar xz".format(download_url))
+        with mirror.source(download_url, get_config().get('setuptools_sha256')) as unpack_cmd:
+            fab.run(unpack_cmd)
         with fab.cd('setuptools-*'):
             fab.puts("Uninstalling setuptools for python {0}".format(version))
             fab.sudo("{0} setup.py install --record setuptools_files.txt".format(python_bin))
@@ -113,6 +292,7 @@ def uninstall():
     fab.puts("Removing {0}".format(install_dir))
     if fab.confirm("Are you sure?", default=False):
         fab.sudo("rm -rf '{0}'".format(install_dir))
+        facts.invalidate()
         fab.puts("Python {0} uninstalled".format(version))
 
 
@@ -124,11 +304,12 @@ def install_pip():
     fab.puts("Installing pip for python {0}".format(py_version))
     easy_install_bin = _python_bin_path(py_version, 'easy_install')
 
-    if not cuisine.file_exists(easy_install_bin):
+    if not facts.file_exists(easy_install_bin):
         fab.puts("easy_install for version {0} not found".format(py_version))
         return
 
     fab.sudo('{0} pip'.format(easy_install_bin))
+    facts.invalidate()
 
 
 @fab.task
@@ -144,11 +325,12 @@ def install_pypi_package(package, use_virtualenv=True):
     else:
         pip_bin = _python_bin_path(py_version, 'pip')
 
-    if not cuisine.file_exists(pip_bin):
+    if not facts.file_exists(pip_bin):
         fab.puts("pip for version {0} not found".format(py_version))
         return
 
     fab.sudo('{cmd} install {package}'.format(cmd=pip_bin, package=package))
+    facts.invalidate()
 
 
 @fab.task
@@ -164,21 +346,28 @@ def uninstall_pypi_package(package, use_virtualenv=True):
     else:
         pip_bin = _python_bin_path(py_version, 'pip')
 
-    if not cuisine.file_exists(pip_bin):
+    if not facts.file_exists(pip_bin):
         fab.puts("pip for version {0} not found".format(py_version))
         return
 
     fab.sudo('{cmd} uninstall --yes {package}'.format(cmd=pip_bin, package=package))
+    facts.invalidate()
 
 
 @fab.task
-def create_virtualenv():
-    """Create virtualenv for project."""
+def create_virtualenv(release=None):
+    """Create virtualenv for project.
+
+    If `release` is given a virtualenv of its own is created, see
+    `create_release_virtualenv`."""
+    if release:
+        return create_release_virtualenv(release)
+
     site = get_project_name()
     version = get_config()['version']
 
     virtualenv_dir = "{}/{}/virtualenv".format(SITES_DIR, site)
-    if cuisine.dir_exists(virtualenv_dir + "/bin"):
+    if facts.dir_exists(virtualenv_dir + "/bin"):
         fab.puts("virtualenv for {0} already exists".format(site))
         return
 
@@ -188,27 +377,214 @@ def create_virtualenv():
     venv_bin = _python_bin_path(version, 'virtualenv')
     fab.sudo("{venv_bin} {virtualenv_dir}".format(venv_bin=venv_bin,
              virtualenv_dir=virtualenv_dir))
+    facts.invalidate()
+
+
+def create_release_virtualenv(release):
+    """Create the virtualenv of release `release`.
+
+    The virtualenv lives in `virtualenvs/<release>` and is seeded from the
+    active one, with hardlinks (or a copy if the python `virtualenv_copy`
+    setting is set), so `install_requirements` only applies what changed.
+    `project.activate` switches the `virtualenv` symlink along with the code."""
+    site = get_project_name()
+    version = get_config()['version']
 
+    virtualenv_dir = _virtualenv_dir(site, release)
+    if facts.dir_exists(virtualenv_dir + "/bin"):
+        fab.puts("virtualenv for {0} release {1} already exists".format(site, release))
+        return
+
+    # resolve only the `virtualenv` link itself, the scripts of the active
+    # virtualenv hold paths through any symlinked parent directory
+    active_cmd = ('if [ -L {venv} ]; then target=$(readlink {venv}) && '
+                  'case "$target" in /*) echo "$target";; *) echo "{site_dir}/$target";; esac; '
+                  'elif [ -d {venv} ]; then echo {venv}; else false; fi')
+    with fab.settings(fab.hide('everything'), warn_only=True):
+        active_dir = fab.run(active_cmd.format(venv=_virtualenv_dir(site), site_dir=os.path.join(SITES_DIR, site)))
+    if active_dir.failed or not active_dir.strip():
+        fab.puts("Creating virtualenv for {0} release {1}".format(site, release))
+        venv_bin = _python_bin_path(version, 'virtualenv')
+        fab.sudo("mkdir -p {0} && {1} {0}".format(virtualenv_dir, venv_bin))
+        facts.invalidate()
+        return
 
-def _get_virtualenv_bin(site, binary):
+    active_dir = active_dir.strip()
+    fab.puts("Cloning virtualenv {0} for {1} release {2}".format(active_dir, site, release))
+    with batch(use_sudo=True) as cmds:
+        cmds.run('mkdir -p {0}'.format(os.path.dirname(virtualenv_dir)))
+        cmds.run('cp -a{link} {src} {dst}.tmp'.format(
+                 link='' if get_config().get('virtualenv_copy') else 'l', src=active_dir, dst=virtualenv_dir))
+        # sed -i writes new files, so hardlinks shared with the source are never modified
+        cmds.run("{{ grep -rlIZ -F {src} {dst}.tmp/bin; "
+                 "find {dst}.tmp/lib -name '*.pth' -print0 -o -name '*.egg-link' -print0 | "
+                 "xargs -0 -r grep -lZ -F {src}; }} | xargs -0 -r sed -i 's|{src}|{dst}|g'".format(
+                 src=active_dir, dst=virtualenv_dir))
+        cmds.run("find {dst}.tmp -maxdepth 3 -type l -lname '{src}/*' | while read link; do "
+                 "target=$(readlink \"$link\"); ln -sfn \"{dst}${{target#{src}}}\" \"$link\"; done".format(
+                 src=active_dir, dst=virtualenv_dir))
+        cmds.run("if grep -qF {src} {dst}.tmp/bin/pip; then rm -rf {dst}.tmp; "
+                 "echo 'Cloned virtualenv still points to {src}' >&2; false; fi".format(
+                 src=active_dir, dst=virtualenv_dir))
+        cmds.run('mv {0}.tmp {0}'.format(virtualenv_dir))
+    facts.invalidate()
+
+
+def _virtualenv_dir(site, release=None):
+    if release:
+        return os.path.join(SITES_DIR, site, 'virtualenvs', release)
+    return os.path.join(SITES_DIR, site, 'virtualenv')
+
+
+def _get_virtualenv_bin(site, binary, release=None):
     """Grabs a binary in a given virtualenv"""
-    bin_dir = os.path.join(SITES_DIR, site, 'virtualenv', 'bin')
+    bin_dir = os.path.join(_virtualenv_dir(site, release), 'bin')
     return os.path.join(bin_dir, binary)
 
 
 @fab.task
-def install_requirements(upgrade=False):
-    """Install `site` project's requirements"""
+def install_requirements(upgrade=False, wheelhouse=False, release=None):
+    """Install `site` project's requirements
+
+    If `wheelhouse` or the python `wheelhouse` setting is set, requirements
+    are installed offline from wheels built once per interpreter. If
+    `release` is given they go to that release's virtualenv, and packages
+    dropped from the requirements since it was cloned are uninstalled."""
     site = get_project_name()
     project_dir = get_proj_config()['project_dir']
 
-    pip = _get_virtualenv_bin(site, 'pip')
+    if release:
+        _uninstall_removed_requirements(site, release, "{}/requirements.txt".format(project_dir))
+
+    if wheelhouse or get_config().get('wheelhouse'):
+        return install_requirements_from_wheelhouse(upgrade, release)
+
+    pip = _get_virtualenv_bin(site, 'pip', release)
     requirements = open("{}/requirements.txt".format(project_dir)).read().replace("\n", " ")
     fab.sudo("{pip} install {upgrade} {requirements}".format(
              pip=pip, upgrade="--upgrade" if upgrade else "",
              requirements=requirements))
 
 
+def install_requirements_from_wheelhouse(upgrade=False, release=None):
+    """Install `site` project's requirements from a local wheelhouse.
+
+    Wheels are built on the first host that needs them and cached locally,
+    keyed by the requirements, the virtualenv interpreter and the host
+    distro (wheels with C extensions link against its libraries). Each host only
+    receives the wheels it does not have yet, in a single transfer, and
+    installs them with `--no-index`. Nothing runs when the virtualenv was
+    already installed from the same requirements."""
+    site = get_project_name()
+    project_dir = get_proj_config()['project_dir']
+    requirements_file = "{}/requirements.txt".format(project_dir)
+
+    pip = _get_virtualenv_bin(site, 'pip', release)
+    python_bin = _get_virtualenv_bin(site, 'python', release)
+    marker = os.path.join(os.path.dirname(os.path.dirname(pip)), _REQUIREMENTS_MARKER)
+
+    with fab.settings(fab.hide('everything')):
+        interpreter = str(fab.run(
+            "{0} -c 'import sys, sysconfig; "
+            "print(\"%d.%d-%d-%s\" % (sys.version_info[0], sys.version_info[1], "
+            "sys.maxunicode, sysconfig.get_platform()))'".format(python_bin))).strip()
+
+    requirements = open(requirements_file, 'rb').read()
+    requirements_hash = cache.cache_key(hashlib.sha1(requirements).hexdigest(), interpreter, facts.get()['distro'])
+
+    with fab.settings(fab.hide('everything'), warn_only=True):
+        installed = fab.run('cat {0}'.format(marker))
+    if not upgrade and installed.succeeded and installed.strip() == requirements_hash:
+        fab.puts("Requirements for {0} already installed, skipping".format(site))
+        return
+
+    wheels_dir = cache.lookup('wheels', requirements_hash)
+    if not wheels_dir:
+        wheels_dir = _build_wheels(pip, requirements_file, requirements_hash)
+
+    remote_requirements = os.path.join(WHEELHOUSE_DIR, '{0}.txt'.format(requirements_hash))
+    with fab.settings(fab.hide('everything')):
+        remote_wheels = str(fab.sudo('mkdir -p {0} && ls -1 {0}'.format(WHEELHOUSE_DIR))).split()
+    missing = sorted(set(os.listdir(wheels_dir)) - set(remote_wheels))
+
+    if missing:
+        fab.puts("Sending {0} wheels to {1}".format(len(missing), fab.env.host_string))
+        local_temp_dir = mkdtemp()
+        bundle = os.path.join(local_temp_dir, 'wheels.tar')
+        fab.local('tar cf {0} -C {1} {2}'.format(bundle, wheels_dir, ' '.join(missing)))
+        fab.put(bundle, '/tmp/fabix-wheels.tar')
+        fab.local('rm -rf {0}'.format(local_temp_dir))
+    with cuisine.mode_sudo():
+        cuisine.file_upload(remote_requirements, requirements_file)
+
+    with batch(use_sudo=True) as cmds:
+        if missing:
+            cmds.run('tar xf /tmp/fabix-wheels.tar -C {0} && rm -f /tmp/fabix-wheels.tar'.format(WHEELHOUSE_DIR))
+        cmds.run("{pip} install {upgrade} --no-index --find-links {wheelhouse} -r {requirements}".format(
+                 pip=pip, upgrade="--upgrade" if upgrade else "",
+                 wheelhouse=WHEELHOUSE_DIR, requirements=remote_requirements))
+        cmds.run('echo {0} > {1}.tmp && mv {1}.tmp {1}'.format(requirements_hash, marker))
+
+
+def _uninstall_removed_requirements(site, release, requirements_file):
+    """Uninstall packages no longer in `requirements_file` from `release` virtualenv.
+
+    A copy of the requirements is kept in the virtualenv, so the next clone
+    knows what it was installed from."""
+    pip = _get_virtualenv_bin(site, 'pip', release)
+    saved_requirements = os.path.join(_virtualenv_dir(site, release), _REQUIREMENTS_COPY)
+
+    with fab.settings(fab.hide('everything'), warn_only=True):
+        previous = fab.run('cat {0}'.format(saved_requirements))
+    removed = set()
+    if previous.succeeded:
+        removed = _requirement_names(str(previous)) - _requirement_names(open(requirements_file).read())
+
+    if removed:
+        fab.puts("Uninstalling {0}".format(' '.join(sorted(removed))))
+        fab.sudo('{0} uninstall --yes {1}'.format(pip, ' '.join(sorted(removed))))
+
+    # the file may be a hardlink shared with the source virtualenv, replace it
+    fab.put(requirements_file, '/tmp/fabix-requirements-{0}.txt'.format(release))
+    fab.sudo('mv /tmp/fabix-requirements-{0}.txt {1}'.format(release, saved_requirements))
+
+
+def _requirement_names(requirements):
+    names = set()
+    for line in requirements.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line or line.startswith('-') or '://' in line:
+            continue
+        match = re.match(r'[A-Za-z0-9][A-Za-z0-9._-]*', line)
+        if match:
+            names.add(match.group(0).lower().replace('_', '-'))
+    return names
+
+
+def _build_wheels(pip, requirements_file, requirements_hash):
+    """Build wheels for `requirements_file` on this host and cache them locally."""
+    fab.puts("Building wheels on {0}".format(fab.env.host_string))
+    remote_temp_dir = fab.run('mktemp -d')
+    remote_requirements = os.path.join(remote_temp_dir, 'requirements.txt')
+    fab.put(requirements_file, remote_requirements)
+
+    with fab.cd(remote_temp_dir):
+        fab.sudo('{0} install wheel'.format(pip))
+        fab.sudo('{0} wheel -r requirements.txt -w wheels'.format(pip))
+        fab.sudo('tar cf wheels.tar -C wheels .')
+
+    local_temp_dir = mkdtemp()
+    wheels_dir = os.path.join(local_temp_dir, 'wheels')
+    os.mkdir(wheels_dir)
+    fab.get(os.path.join(remote_temp_dir, 'wheels.tar'), os.path.join(local_temp_dir, 'wheels.tar'))
+    fab.local('tar xf {0}/wheels.tar -C {1}'.format(local_temp_dir, wheels_dir))
+    fab.sudo('rm -rf {0}'.format(remote_temp_dir))
+
+    wheels_dir = cache.store('wheels', requirements_hash, wheels_dir)
+    fab.local('rm -rf {0}'.format(local_temp_dir))
+    return wheels_dir
+
+
 @fab.task
 def setup():
     """Install python, setuptools, pip and virtualenv."""
@@ -0,0 +1,31 @@
+"""Micro-benchmark used by `fabix.python.benchmark` to compare python builds.
+
+Prints one line per test with its name and best time in seconds. Runs
+unchanged on python 2 and 3."""
+from __future__ import print_function
+
+import sys
+import timeit
+
+TESTS = [
+    ('calls', 'def f(a, b):\n    return a + b', 'for i in range(1000):\n    f(i, i)'),
+    ('loops', '', 'total = 0\nfor i in range(2000):\n    total += i * i'),
+    ('dicts', 'keys = [str(i) for i in range(500)]',
+     'd = {}\nfor k in keys:\n    d[k] = k\nfor k in keys:\n    d[k]'),
+    ('strings', 'words = ["word%d" % i for i in range(500)]',
+     '"-".join(words).upper().split("-")'),
+    ('sorting', 'import random\nrandom.seed(1)\ndata = [random.random() for i in range(2000)]',
+     'sorted(data)'),
+    ('classes', 'class P(object):\n    def __init__(self, x):\n        self.x = x\n    def get(self):\n        return self.x',
+     'for i in range(500):\n    P(i).get()'),
+]
+
+
+def main(repeat=5, number=200):
+    for name, setup, stmt in TESTS:
+        best = min(timeit.repeat(stmt, setup, repeat=repeat, number=number))
+        print(name, '%.6f' % best)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,126 @@
+# coding: utf-8
+import fnmatch
+import json
+import os
+import time
+
+import cuisine
+import fabric.api as fab
+
+from fabix import cache
+
+# Seconds facts are kept on disk between runs, 0 disables the disk cache.
+CACHE_TTL = 0
+
+# Paths whose existence is collected with the facts. Existence checks for
+# other paths always go to the host.
+TRACKED_PATHS = [
+    '/opt/python/*/bin/python',
+    '/opt/python/*/bin/easy_install',
+    '/opt/python/*/bin/pip',
+    '/opt/python/*/bin/virtualenv',
+    '/opt/nginx/*/sbin/nginx',
+    '/data/sites/*/virtualenv/bin',
+    '/data/sites/*/virtualenv/bin/pip',
+    '/data/sites/*/virtualenvs/*/bin',
+    '/data/sites/*/virtualenvs/*/bin/pip',
+]
+
+_FACTS_SCRIPT = """\
+echo "distro=$(lsb_release -sc 2>/dev/null)-$(uname -m)"
+echo "cpu_count=$(nproc)"
+echo "memory_kb=$(awk '/^MemTotal:/ {{print $2}}' /proc/meminfo)"
+echo "fd_limit=$(ulimit -Hn)"
+echo "file_max=$(cat /proc/sys/fs/file-max)"
+echo "disk_free_kb=$(df -Pk /var | awk 'NR == 2 {{print $4}}')"
+ls -1d {paths} 2>/dev/null | sed 's/^/path=/'
+true"""
+
+_facts = {}
+
+
+def get(refresh=False):
+    """Return facts about the current host, collected in one remote call.
+
+    Facts are memoized per host for the whole run and, if `CACHE_TTL` is
+    set, on disk between runs."""
+    host = fab.env.host_string
+    if not refresh and host in _facts:
+        return _facts[host]
+
+    cache_file = cache.entry_path('facts', cache.cache_key(host), '.json')
+    if not refresh and CACHE_TTL and os.path.exists(cache_file) and \
+            time.time() - os.path.getmtime(cache_file) < CACHE_TTL:
+        with open(cache_file) as fd:
+            _facts[host] = json.load(fd)
+        return _facts[host]
+
+    with fab.settings(fab.hide('everything')):
+        output = fab.run(_FACTS_SCRIPT.format(paths=' '.join(TRACKED_PATHS)))
+
+    facts = {'paths': []}
+    for line in str(output).splitlines():
+        name, _, value = line.strip().partition('=')
+        if name == 'path':
+            facts['paths'].append(value)
+        elif name == 'distro':
+            facts[name] = value
+        elif name:
+            facts[name] = int(value) if value.isdigit() else None
+
+    _facts[host] = facts
+    if CACHE_TTL:
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        with open(cache_file, 'w') as fd:
+            json.dump(facts, fd)
+    return facts
+
+
+def invalidate():
+    """Forget facts about the current host, after changing what they describe."""
+    host = fab.env.host_string
+    _facts.pop(host, None)
+
+    cache_file = cache.entry_path('facts', cache.cache_key(host), '.json')
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+
+
+def _tracked(path):
+    return any(fnmatch.fnmatch(path, pattern) for pattern in TRACKED_PATHS)
+
+
+def file_exists(path):
+    """Tell whether `path` exists, from facts if it is a tracked path."""
+    path = os.path.normpath(path)
+    if _tracked(path):
+        return path in get()['paths']
+    return cuisine.file_exists(path)
+
+
+def dir_exists(path):
+    """Tell whether directory `path` exists, from facts if it is a tracked path."""
+    path = os.path.normpath(path)
+    if _tracked(path):
+        return path in get()['paths']
+    return cuisine.dir_exists(path)
+
+
+def versions(name):
+    """Return versions of `name` (python or nginx) installed under /opt."""
+    binary = {'python': 'bin/python', 'nginx': 'sbin/nginx'}[name]
+    prefix = '/opt/{0}/'.format(name)
+    return sorted(path[len(prefix):-len(binary) - 1] for path in get()['paths']
+                  if path.startswith(prefix) and path.endswith('/' + binary))
+
+
+@fab.task
+def show(refresh=False):
+    """Show facts about the current host."""
+    facts = get(refresh)
+    for name in sorted(facts):
+        if name != 'paths':
+            fab.puts("{0}: {1}".format(name, facts[name]))
+    fab.puts("python: {0}".format(' '.join(versions('python'))))
+    fab.puts("nginx: {0}".format(' '.join(versions('nginx'))))
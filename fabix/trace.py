@@ -0,0 +1,208 @@
+# coding: utf-8
+"""Timing instrumentation for fabix runs.
+
+Once enabled, every task, remote or local command and file transfer is
+recorded as a span with its host, duration, bytes sent or received and exit
+status. Code can add its own spans with `span`. At the end of the run spans
+are exported as JSON and in Chrome trace format (load it in
+chrome://tracing or Perfetto) and the slowest ones are summarized.
+
+Enable it from the command line before the tasks to trace:
+
+    fab trace.start:deploy.json project.upload_all project.activate:...
+"""
+import atexit
+import json
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import fabric.api as fab
+import fabric.tasks
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+_spool = None
+_output = None
+_main_pid = None
+_summary_size = 10
+
+
+@contextmanager
+def span(name, kind='step', **attrs):
+    """Record the enclosed block as a span named `name`.
+
+    The block may update the yielded dict, e.g. to set `bytes_sent` or `status`."""
+    if _spool is None:
+        yield attrs
+        return
+
+    start = time.time()
+    attrs.setdefault('status', 0)
+    try:
+        yield attrs
+    except BaseException:
+        attrs['status'] = 1
+        raise
+    finally:
+        _record(name, kind, start, time.time() - start, attrs)
+
+
+def _record(name, kind, start, duration, attrs):
+    event = dict(attrs, name=name, kind=kind, start=start, duration=duration,
+                 host=fab.env.host_string or 'localhost', pid=os.getpid())
+    # a single O_APPEND write per span keeps lines whole across parallel workers
+    fd = os.open(_spool, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(event) + '\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+def _size(path):
+    if not isinstance(path, string_types) or not os.path.exists(path):
+        return 0
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, fname))
+               for root, dirs, files in os.walk(path) for fname in files)
+
+
+def _trace_command(func):
+    @wraps(func)
+    def inner(command, *args, **kwargs):
+        with span(command[:200], 'command', bytes_sent=len(command)) as attrs:
+            result = func(command, *args, **kwargs)
+            attrs['bytes_received'] = len(result or '')
+            attrs['status'] = getattr(result, 'return_code', 0)
+        return result
+    return inner
+
+
+def _trace_put(func):
+    @wraps(func)
+    def inner(local_path=None, remote_path=None, *args, **kwargs):
+        name = 'put {0} {1}'.format(local_path, remote_path)
+        with span(name, 'transfer', bytes_sent=_size(local_path)) as attrs:
+            result = func(local_path, remote_path, *args, **kwargs)
+            attrs['status'] = 0 if result.succeeded else 1
+        return result
+    return inner
+
+
+def _trace_get(func):
+    @wraps(func)
+    def inner(remote_path, local_path=None, *args, **kwargs):
+        name = 'get {0} {1}'.format(remote_path, local_path)
+        with span(name, 'transfer') as attrs:
+            result = func(remote_path, local_path, *args, **kwargs)
+            attrs['bytes_received'] = sum(_size(path) for path in result)
+            attrs['status'] = 0 if result.succeeded else 1
+        return result
+    return inner
+
+
+def _trace_task(func):
+    @wraps(func)
+    def inner(self, *args, **kwargs):
+        with span(self.name, 'task'):
+            return func(self, *args, **kwargs)
+    return inner
+
+
+def enable(output='fabix-trace.json', summary_size=10):
+    """Start recording spans, exported to `output` when the run ends."""
+    global _spool, _output, _main_pid, _summary_size
+    if _spool is not None:
+        return
+
+    _output, _main_pid, _summary_size = output, os.getpid(), int(summary_size)
+    _spool = output + '.spans'
+    open(_spool, 'w').close()
+
+    for name in ('run', 'sudo', 'local'):
+        setattr(fab, name, _trace_command(getattr(fab, name)))
+    fab.put = _trace_put(fab.put)
+    fab.get = _trace_get(fab.get)
+
+    # __call__ goes through run, wrapping both would record tasks twice
+    task_class = fabric.tasks.WrappedCallableTask
+    task_class.run = _trace_task(task_class.run)
+
+    atexit.register(_finish)
+
+
+def load(spool=None):
+    """Return recorded spans, ordered by start time."""
+    spans = []
+    with open(spool or _spool) as fd:
+        for line in fd:
+            if line.strip():
+                spans.append(json.loads(line))
+    return sorted(spans, key=lambda event: event['start'])
+
+
+def export_json(spans, path):
+    with open(path, 'w') as fd:
+        json.dump(spans, fd, indent=2)
+
+
+def export_chrome(spans, path):
+    """Write `spans` in Chrome trace event format, one thread per host."""
+    hosts = sorted(set(event['host'] for event in spans))
+    origin = min(event['start'] for event in spans) if spans else 0
+
+    events = []
+    for pid in sorted(set(event['pid'] for event in spans)):
+        for tid, host in enumerate(hosts):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': host}})
+    for event in spans:
+        args = dict((key, value) for key, value in event.items()
+                    if key not in ('name', 'kind', 'start', 'duration', 'pid'))
+        events.append({
+            'name': event['name'], 'cat': event['kind'], 'ph': 'X',
+            'ts': int((event['start'] - origin) * 1e6), 'dur': int(event['duration'] * 1e6),
+            'pid': event['pid'], 'tid': hosts.index(event['host']), 'args': args,
+        })
+
+    with open(path, 'w') as fd:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fd)
+
+
+def summary(spans, size=10):
+    """Print totals per kind of span and the `size` slowest non-task spans."""
+    totals = {}
+    for event in spans:
+        count, duration = totals.get(event['kind'], (0, 0.0))
+        totals[event['kind']] = (count + 1, duration + event['duration'])
+    for kind in sorted(totals):
+        fab.puts("{0}: {1} spans, {2:.2f}s".format(kind, totals[kind][0], totals[kind][1]))
+
+    fab.puts("Slowest steps:")
+    steps = [event for event in spans if event['kind'] != 'task']
+    for event in sorted(steps, key=lambda event: event['duration'], reverse=True)[:size]:
+        transferred = event.get('bytes_sent', 0) + event.get('bytes_received', 0)
+        fab.puts("{0:>9.2f}s {1:<24} {2:>10}B exit={3} {4}".format(
+            event['duration'], event['host'], transferred, event['status'], event['name']))
+
+
+def _finish():
+    if os.getpid() != _main_pid:
+        return
+
+    spans = load()
+    base, ext = os.path.splitext(_output)
+    export_json(spans, _output)
+    export_chrome(spans, '{0}.chrome{1}'.format(base, ext or '.json'))
+    os.remove(_spool)
+    summary(spans, _summary_size)
+
+
+@fab.task
+def start(output='fabix-trace.json', summary_size=10):
+    """Trace the tasks that follow, writing spans to `output`."""
+    enable(output, summary_size)
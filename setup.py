@@ -36,5 +36,5 @@ setup(
     packages=find_packages(),
     install_requires=open(requirements_file, "rb").read().decode(encoding).split("\n"),
     package_dir={"fabix": "fabix"},
-    package_data={'fabix': ["support_files/etc/init/*.conf"]}
+    package_data={'fabix': ["support_files/etc/init/*.conf", "support_files/etc/nginx/*.conf", "support_files/bench/*.py"]}
 )